@@ -0,0 +1,143 @@
+"""
+Writes a synthetic blockchain database with the same key layout as a citizen node:
+
+    block_height_key + 12 byte height -> block hash
+    block hash                        -> block json
+    txhash                            -> transaction result json
+
+Blocks below Block.V3_BLOCK_HEIGHT are written in the v1 format (confirmed_transaction_list, time_stamp)
+with v1 transactions (no version, tx_hash), blocks from it in the v3 format (transactions, hex timestamp)
+with v3 transactions. By default the chain starts so half of the blocks are on each side.
+
+usage: python3 benchmarks/generate.py --db <path> [--blocks n] [--txs n] [--match-ratio r]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from blockchain import Block
+from blockchain import Transaction
+import plyvel
+
+
+GOVERNANCE = "cx" + "0" * 40
+BLOCK_INTERVAL = 2000000
+
+
+def address(i: int, prefix: str = "hx") -> str:
+    return prefix + format(i, "040x")
+
+
+def make_v1_transaction(rng: random.Random, height: int, i: int, timestamp: int, args) -> dict:
+    """
+    Return a v1 transaction. v1 transactions have no version, data or datatype, so they are all icx transfers.
+    """
+    return {"from": address(rng.randrange(args.addresses)),
+            "to": address(rng.randrange(args.addresses)),
+            "value": hex(rng.randrange(10 ** 21)),
+            "fee": "0x2386f26fc10000",
+            "timestamp": str(timestamp - rng.randrange(10 ** 6)),
+            "nonce": str(rng.randrange(10 ** 6)),
+            "signature": "".join(rng.choice("abcdef0123456789") for _ in range(88)),
+            "method": "icx_sendTransaction",
+            "tx_hash": format(height * 1000 + i, "064x")}
+
+
+def make_transaction(rng: random.Random, height: int, i: int, timestamp: int, args) -> dict:
+    """
+    Return a transaction in the version of the block at height.
+    From the v3 block height a share of match_ratio are setDelegation calls to the governance contract,
+    the rest are icx transfers and calls to other contracts.
+    """
+    if height < Block.V3_BLOCK_HEIGHT:
+        return make_v1_transaction(rng, height, i, timestamp, args)
+
+    txhash = "0x" + format(height * 1000 + i, "064x")
+    transaction = {"version": "0x3",
+                   "from": address(rng.randrange(args.addresses)),
+                   "stepLimit": "0x" + format(rng.randrange(10 ** 6, 10 ** 7), "x"),
+                   "timestamp": hex(timestamp - rng.randrange(10 ** 6)),
+                   "nid": "0x1",
+                   "nonce": hex(rng.randrange(10 ** 6)),
+                   "signature": "".join(rng.choice("abcdef0123456789") for _ in range(88)),
+                   "txHash": txhash}
+
+    if rng.random() < args.match_ratio:
+        transaction["to"] = GOVERNANCE
+        transaction["value"] = "0x0"
+        transaction["dataType"] = "call"
+        transaction["data"] = {"method": "setDelegation",
+                               "params": {"delegations": [{"address": address(rng.randrange(100)),
+                                                           "value": hex(rng.randrange(10 ** 22))}]}}
+    elif rng.random() < 0.5:
+        transaction["to"] = address(rng.randrange(args.addresses))
+        transaction["value"] = hex(rng.randrange(10 ** 21))
+    else:
+        transaction["to"] = address(rng.randrange(1, 50), "cx")
+        transaction["value"] = "0x0"
+        transaction["dataType"] = "call"
+        transaction["data"] = {"method": "transfer",
+                               "params": {"_to": address(rng.randrange(args.addresses)),
+                                          "_value": hex(rng.randrange(10 ** 21))}}
+    return transaction
+
+
+def make_block(height: int, transactions: list, timestamp: int) -> dict:
+    if height < Block.V3_BLOCK_HEIGHT:
+        return {"version": "0.1a", "prev_block_hash": format(height - 1, "064x"), "merkle_tree_root_hash": "0" * 64,
+                "time_stamp": timestamp, "confirmed_transaction_list": transactions,
+                "block_hash": format(height, "064x"), "height": height, "peer_id": address(0), "signature": ""}
+    return {"version": "0.5", "height": height, "timestamp": hex(timestamp), "prevHash": format(height - 1, "064x"),
+            "transactionsHash": "0" * 64, "stateHash": "0" * 64, "receiptsHash": "0" * 64, "logsBloom": "0x" + "0" * 512,
+            "leader": address(0), "transactions": transactions, "hash": format(height, "064x"), "signature": ""}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = "generate", description = "Write a synthetic blockchain database.")
+    parser.add_argument('--db', type = str, required = True, help = "Path of the database to create.")
+    parser.add_argument('--blocks', type = int, default = 20000, help = "Number of blocks.")
+    parser.add_argument('--start', type = int, help = "First block height. Default straddles the v3 block height.")
+    parser.add_argument('--txs', type = int, default = 10, help = "Average transactions per block.")
+    parser.add_argument('--match-ratio', type = float, default = 0.05, dest = "match_ratio",
+                        help = "Share of v3 transactions that are setDelegation calls to the governance contract.")
+    parser.add_argument('--failed-ratio', type = float, default = 0.05, dest = "failed_ratio",
+                        help = "Share of failed transactions.")
+    parser.add_argument('--addresses', type = int, default = 1000, help = "Number of distinct wallet addresses.")
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+
+    start = args.start if args.start is not None else Block.V3_BLOCK_HEIGHT - args.blocks // 2
+    rng = random.Random(args.seed)
+    db = plyvel.DB(args.db, create_if_missing = True, error_if_exists = True)
+
+    transactions = 0
+    for height in range(start, start + args.blocks):
+        timestamp = 1600000000000000 + height * BLOCK_INTERVAL
+        block_transactions = [make_transaction(rng, height, i, timestamp, args)
+                              for i in range(rng.randrange(2 * args.txs + 1))]
+
+        blockhash = format(height, "064x").encode()
+        with db.write_batch() as batch:
+            batch.put(Block.height_key(height), blockhash)
+            batch.put(blockhash, json.dumps(make_block(height, block_transactions, timestamp)).encode())
+            for transaction in block_transactions:
+                txhash = Transaction(transaction, None).txhash
+                status = "0x0" if rng.random() < args.failed_ratio else "0x1"
+                result = {"result": {"txHash": txhash, "status": status, "blockHeight": hex(height),
+                                     "stepUsed": "0x186a0", "stepPrice": "0x2540be400", "eventLogs": []}}
+                batch.put(txhash.encode(), json.dumps(result).encode())
+        transactions += len(block_transactions)
+    db.close()
+
+    # Read by run.py.
+    with open(args.db.rstrip("/") + ".json", 'w') as meta:
+        json.dump({"firstblock": start, "lastblock": start + args.blocks - 1, "transactions": transactions}, meta)
+
+    print(f"Wrote blocks {start}-{start + args.blocks - 1} with {transactions} transactions to {args.db}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Serves a database written by generate.py over JSON-RPC, for running itx with source = rpc without a node.
+
+Answers icx_getBlockByHeight, icx_getTransactionResult and icx_getLastBlock, single or batched.
+Blocks are returned in the api's format, with confirmed_transaction_list and an integer time_stamp for every height.
+Latency and failing requests can be simulated.
+
+usage: python3 benchmarks/rpc_server.py --db <path> [--port 9000] [--latency seconds] [--fail-ratio r]
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from blockchain import Block
+import plyvel
+
+
+def handle(db, request: dict) -> dict:
+    method, params = request.get("method"), request.get("params") or {}
+    response = {"jsonrpc": "2.0", "id": request.get("id")}
+
+    if method == "icx_getBlockByHeight":
+        height = int(params["height"], 16)
+        raw = Block.get_raw_block(height, db)
+        if raw is None:
+            response["error"] = {"code": -32602, "message": "fail wrong block height"}
+            return response
+        block = json.loads(raw)
+        if "transactions" in block:
+            block = {"version": block.get("version"), "height": height, "block_hash": block.get("hash"),
+                     "time_stamp": int(block["timestamp"], 16), "confirmed_transaction_list": block["transactions"]}
+        response["result"] = block
+
+    elif method == "icx_getTransactionResult":
+        raw = db.get(params["txHash"].encode())
+        if raw is None:
+            response["error"] = {"code": -32602, "message": "Invalid params txHash"}
+            return response
+        response["result"] = json.loads(raw)["result"]
+
+    elif method == "icx_getLastBlock":
+        response["result"] = {"height": Block.last_height(db)}
+
+    else:
+        response["error"] = {"code": -32601, "message": "Method not found"}
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = "rpc_server", description = "Serve a database over JSON-RPC.")
+    parser.add_argument('--db', type = str, required = True, help = "Database written by generate.py.")
+    parser.add_argument('--port', type = int, default = 9000)
+    parser.add_argument('--latency', type = float, default = 0, help = "Seconds added to every request.")
+    parser.add_argument('--fail-ratio', type = float, default = 0, dest = "fail_ratio",
+                        help = "Share of requests answered with 503.")
+    args = parser.parse_args()
+
+    db = plyvel.DB(args.db, create_if_missing = False)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            if args.latency:
+                time.sleep(args.latency)
+            if random.random() < args.fail_ratio:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            request = json.loads(body)
+            if isinstance(request, list):
+                response = [handle(db, item) for item in request]
+            else:
+                response = handle(db, request)
+            data = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    server.daemon_threads = True
+    print(f"Serving {args.db} on http://127.0.0.1:{args.port}/api/v3")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Times itx extract and update against a database written by generate.py.
+
+Each rule set gets its own working directory and itx.ini. The files are initialized, the first half of
+the chain is extracted with extract and the rest with update. Every command runs as its own process,
+so peak memory is measured per command.
+
+usage: python3 benchmarks/run.py --db <path> [--rules <rule sets>] [--set key=value ...] [--json <file>]
+"""
+import argparse
+import configparser
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+ITX = os.path.join(ROOT, "itx.py")
+GOVERNANCE = "cx" + "0" * 40
+
+
+def address(i: int) -> str:
+    return "hx" + format(i, "040x")
+
+
+# Rule set -> init arguments for each file.
+RULES = {
+    "governance": [["--to", GOVERNANCE, "--methods", "setDelegation"]],
+    "wallets": [["--from"] + [address(i) for i in range(20)]],
+    "everything": [["--include-failed-transactions"]],
+    "successful": [[]],
+    "many-files": [["--from", address(i)] for i in range(100)],
+}
+
+
+def run_command(workdir: str, args: list) -> tuple:
+    """
+    Run itx in workdir.
+    Return:
+        seconds (float), peak rss (int, KiB)
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, ITX] + args, cwd = workdir,
+                               stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"itx {' '.join(args)} failed:\n{stderr.decode()}")
+    return seconds, usage.ru_maxrss
+
+
+def write_config(workdir: str, db: str, overrides: dict) -> None:
+    """
+    Write an itx.ini with the defaults of the repository, pointed at db.
+    """
+    config = configparser.ConfigParser(interpolation = None)
+    config.read(os.path.join(ROOT, "itx.ini"))
+    defaults = {key: value for key, value in config.defaults().items()}
+    for section in config.sections():
+        config.remove_section(section)
+    defaults.update({"output": "output/", "leveldb": db, "index": "index.db"})
+    defaults.update(overrides)
+    config["DEFAULT"] = defaults
+    with open(os.path.join(workdir, "itx.ini"), 'w') as inifile:
+        config.write(inifile)
+
+
+def benchmark(name: str, meta: dict, args) -> list:
+    """
+    Run one rule set.
+    Return:
+        results (list) - a dict for each timed command.
+    """
+    workdir = tempfile.mkdtemp(prefix = f"itx-bench-{name}-")
+    try:
+        write_config(workdir, os.path.abspath(args.db), dict(args.set))
+        os.makedirs(os.path.join(workdir, "output"))
+
+        files = []
+        for i, rules in enumerate(RULES[name]):
+            file = f"{name}-{i}{'.csv' if args.format == 'csv' else '.db' if args.format == 'sqlite' else '.parquet'}"
+            run_command(workdir, ["init", "--file", file, "--format", args.format] + rules)
+            files.append(file)
+
+        first, last = meta["firstblock"], meta["lastblock"]
+        middle = first + (last - first) // 2
+        blocks = last - first + 1
+        phases = [("extract", ["extract", "--files"] + files + ["--first-block", str(first), "--last-block", str(middle),
+                                                                "--workers", str(args.workers)], middle - first + 1),
+                  ("update", ["update", "--files"] + files + ["--last-block", str(last)], last - middle)]
+
+        results = []
+        for phase, command, count in phases:
+            seconds, rss = run_command(workdir, command)
+            # Transactions are spread evenly enough over the chain to estimate each phase's share.
+            transactions = meta["transactions"] * count / blocks
+            results.append({"rules": name, "files": len(files), "command": phase, "blocks": count,
+                            "seconds": round(seconds, 3), "blocks_per_second": round(count / seconds, 1),
+                            "tx_per_second": round(transactions / seconds, 1), "peak_rss_mb": round(rss / 1024, 1)})
+        return results
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors = True)
+        else:
+            print(f"Kept {workdir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = "run", description = "Benchmark itx extract and update.")
+    parser.add_argument('--db', type = str, required = True, help = "Database written by generate.py.")
+    parser.add_argument('--rules', choices = list(RULES), nargs = "+", default = list(RULES),
+                        help = "Rule sets to benchmark.")
+    parser.add_argument('--format', choices = ["csv", "sqlite", "parquet"], default = "csv")
+    parser.add_argument('--workers', type = int, default = 1, help = "Worker processes for extract.")
+    parser.add_argument('--set', type = lambda s: tuple(s.split("=", 1)), nargs = "+", default = [],
+                        metavar = "key=value", help = "Override itx.ini options, e.g. receipt_cache_size=100000.")
+    parser.add_argument('--json', type = str, help = "Also write the results to this file.")
+    parser.add_argument('--keep', action = 'store_true', help = "Keep the working directories.")
+    args = parser.parse_args()
+
+    with open(args.db.rstrip("/") + ".json", 'r') as meta:
+        meta = json.load(meta)
+
+    results = []
+    print(f"{'rules':<12}{'files':>6}{'command':>9}{'blocks':>9}{'seconds':>10}{'blocks/s':>11}{'tx/s':>11}{'rss MB':>9}")
+    for name in args.rules:
+        for result in benchmark(name, meta, args):
+            results.append(result)
+            print(f"{result['rules']:<12}{result['files']:>6}{result['command']:>9}{result['blocks']:>9}"
+                  f"{result['seconds']:>10.2f}{result['blocks_per_second']:>11.1f}{result['tx_per_second']:>11.1f}"
+                  f"{result['peak_rss_mb']:>9.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"db": meta, "format": args.format, "workers": args.workers, "set": dict(args.set),
+                       "results": results}, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
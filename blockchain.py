@@ -1,6 +1,10 @@
 from __future__ import annotations
+from collections import OrderedDict
 import json
-import plyvel
+import operator
+import queue
+from stats import timer
+import threading
 
 
 class Block:
@@ -15,10 +19,14 @@ class Block:
     V4_BLOCK_HEIGHT = 12640761
     V5_BLOCK_HEIGHT = 14473622
 
-    def __init__(self, height: int, db: Leveldb) -> Block:
+    def __init__(self, height: int, db: Leveldb, data: dict = None) -> Block:
         # Parse blockdata into block class.
         # More attributes should be added as needed.
-        block = self.get_block(height, db)
+        # Already decoded blockdata can be passed in with data, then no lookup is done.
+        if data is None:
+            block = self.get_block(height, db)
+        else:
+            block = data
         self.db = db
         self.height = height
         
@@ -30,145 +38,315 @@ class Block:
             self.timestamp = int(block['timestamp'], 16)
 
     
+    @classmethod
+    def skipped(cls, height: int, db: Leveldb) -> Block:
+        """
+        Block without transactions, standing in for a block rejected by a Prefilter before decoding.
+        """
+        block = cls.__new__(cls)
+        block.db = db
+        block.height = height
+        block.transactions = []
+        block.timestamp = None
+        return block
+
+    @classmethod
+    def height_key(cls, height: int) -> bytes:
+        """
+        Return the database key mapping height to block hash.
+        """
+        return cls.BLOCK_HEIGHT_KEY + height.to_bytes(cls.BLOCK_HEIGHT_BYTES_LEN, byteorder='big')
+
     def get_block(self, height, db):
-        heightkey = self.BLOCK_HEIGHT_KEY + height.to_bytes(self.BLOCK_HEIGHT_BYTES_LEN, byteorder='big')
+        heightkey = self.height_key(height)
         blockhash = db.get(heightkey)
         block = json.loads(db.get(blockhash))  # --> TypeError: Argument 'key' has incorrect type (expected bytes, got NoneType)
         return block
 
+    @classmethod
+    def get_raw_block(cls, height: int, db: Leveldb, hashes: BlockHashes = None, fill_cache: bool = True) -> bytes:
+        """
+        Get undecoded blockdata from blockchain database, or a snapshot of it.
+        The block hash is taken from hashes when it has the height.
+        With fill_cache false the reads don't fill leveldb's block cache.
+        Return:
+            block (bytes) - json encoded block or None if block does not exist.
+        """
+        blockhash = hashes.get(height) if hashes else None
+        if blockhash is None:
+            blockhash = db.get(cls.height_key(height), fill_cache = fill_cache)
+        if blockhash is None:
+            return None
+        return db.get(blockhash, fill_cache = fill_cache)
+
 
     def find_last_block(self) -> int:
-        increment = 1000000
-        lastblock = 0
-        while True:
+        return self.last_height(self.db)
+
+    @classmethod
+    def last_height(cls, db: Leveldb, reverse: bool = True) -> int:
+        """
+        Find the height of the last block in the database.
+        Seeks to the last block height key with a reverse iterator, no blocks are read or decoded.
+        Return:
+            height (int) - 0 if the database has no blocks.
+        """
+        keylen = len(cls.BLOCK_HEIGHT_KEY) + cls.BLOCK_HEIGHT_BYTES_LEN
+        with db.iterator(prefix = cls.BLOCK_HEIGHT_KEY, reverse = reverse, include_value = False) as iterator:
+            for key in iterator:
+                if len(key) == keylen:
+                    return int.from_bytes(key[len(cls.BLOCK_HEIGHT_KEY):], byteorder = 'big')
+        return 0
+
+    @classmethod
+    def first_height(cls, db: Leveldb) -> int:
+        """
+        Find the height of the first block in the database, 0 if it has no blocks.
+        """
+        return cls.last_height(db, reverse = False)
+
+
+def decode_block(height: int, db: Leveldb, raw: bytes, prefilter: Prefilter = None, clock: Timer = None) -> Block:
+    """
+    Decode an undecoded block. Blocks the prefilter rejects are not decoded and returned without transactions.
+    clock times the prefilter and decoding if given.
+    """
+    clock = clock or timer()
+    if prefilter:
+        if not prefilter.match(raw):
+            clock.lap("prefilter")
+            clock.count("prefiltered_blocks")
+            return Block.skipped(height, db)
+        clock.lap("prefilter")
+    block = Block(height, db, json.loads(raw))
+    clock.lap("json_loads")
+    return block
+
+
+def stream_blocks(db: Leveldb, heights: range, depth: int = 64, workers: int = 2,
+                  scan: bool = False, fill_cache: bool = True, stats: Stats = None, monitor: list = None,
+                  hashes: BlockHashes = None, prefilter: Prefilter = None):
+    """
+    Read and decode blocks ahead of the consumer.
+
+    Each worker thread reads and decodes every n:th height into its own bounded queue,
+    and the queues are drained round robin so blocks come out in the order of heights.
+    Leveldb reads release the GIL, so disk reads overlap with the work done by the consumer.
+
+    With scan the block hashes are read by one thread iterating the block height keys in order,
+    instead of a point lookup per height. All reads are done from one snapshot.
+    Input:
+        db (Leveldb)      - blockchain database.
+        heights (range)   - heights to read, any sliceable sequence works.
+                            Must be a contiguous range with scan.
+        depth (int)       - maximum number of decoded blocks held in memory.
+        workers (int)     - number of reader/decoder threads.
+        scan (bool)       - read block hashes with an iterator.
+        fill_cache (bool) - let the reads fill leveldb's block cache.
+        stats (Stats)     - records read, decode and wait times if given.
+        monitor (list)    - the queues of decoded blocks are added to it if given, for monitoring.
+        hashes (BlockHashes) - block hashes are taken from it instead of the database where it has them.
+                               Used instead of scan.
+        prefilter (Prefilter) - blocks it rejects are not decoded and yielded without transactions.
+    Yield:
+        block (Block) - stops at the first block missing in the database.
+    """
+    if not heights:
+        return
+    workers = max(1, min(workers, len(heights)))
+    queues = [queue.Queue(maxsize = max(1, depth // workers)) for _ in range(workers)]
+    if monitor is not None:
+        monitor[:] = queues
+    stop = threading.Event()
+    end = object()
+    reader = db.snapshot() if scan else db
+
+    def put(q, item):
+        # Give up if the consumer is gone.
+        while not stop.is_set():
+            try:
+                q.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        while not stop.is_set():
             try:
-                self.get_block(lastblock + increment, self.db)
-            except TypeError:
-                if increment == 1:
-                    return lastblock
-                increment = increment // 10
+                return q.get(timeout = 0.1)
+            except queue.Empty:
                 continue
-            lastblock = lastblock + increment
+        return end
+
+    def lookup(worker):
+        # (height, blockhash) for the heights of one worker.
+        clock = timer(stats)
+        for height in heights[worker::workers]:
+            if hashes:
+                blockhash = hashes.get(height)
+                if blockhash is not None:
+                    yield height, blockhash
+                    continue
+            clock.start()
+            blockhash = reader.get(Block.height_key(height), fill_cache = fill_cache)
+            clock.lap("leveldb_get")
+            yield height, blockhash
+
+    def receive(q):
+        # (height, blockhash) handed out by the scanner.
+        while True:
+            item = get(q)
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def scanner(inputs):
+        i = 0
+        clock = timer(stats)
+        try:
+            iterator = reader.iterator(start = Block.height_key(heights[0]),
+                                       stop = Block.height_key(heights[-1] + 1),
+                                       fill_cache = fill_cache)
+            clock.start()
+            for key, blockhash in iterator:
+                clock.lap("leveldb_scan")
+                if key != Block.height_key(heights[i]):
+                    break
+                if not put(inputs[i % workers], (heights[i], blockhash)):
+                    return
+                i += 1
+                clock.start()
+            # Missing block.
+            if i < len(heights):
+                put(inputs[i % workers], (heights[i], None))
+        except Exception as e:
+            put(inputs[i % workers], e)
+        finally:
+            for q in inputs:
+                put(q, end)
+
+    def read(worker, source):
+        q = queues[worker]
+        clock = timer(stats)
+        try:
+            for height, blockhash in source:
+                if blockhash is None:
+                    put(q, None)
+                    return
+                clock.start()
+                raw = reader.get(blockhash, fill_cache = fill_cache)
+                clock.lap("leveldb_get")
+                block = decode_block(height, db, raw, prefilter, clock)
+                if not put(q, block):
+                    return
+            # Source ran out before all heights were read.
+            put(q, None)
+        except Exception as e:
+            put(q, e)
+
+    threads = []
+    if scan and not hashes:
+        inputs = [queue.Queue(maxsize = max(1, depth // workers)) for _ in range(workers)]
+        threads.append(threading.Thread(target = scanner, args = (inputs,), daemon = True))
+        sources = [receive(q) for q in inputs]
+    else:
+        sources = [lookup(i) for i in range(workers)]
+    for i in range(workers):
+        threads.append(threading.Thread(target = read, args = (i, sources[i]), daemon = True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        clock = timer(stats)
+        for i in range(len(heights)):
+            clock.start()
+            block = queues[i % workers].get()
+            clock.lap("block_wait")
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        if scan:
+            reader.release()
 
 
 class Transaction:
     """
     Transaction class is used for parsing transaction data, retrieving transaction data from a local citizen node
     and perform various tests on a transaction.
+
+    A Transaction is a view of the transaction dict from the block. Fields are read from the dict when they are
+    accessed instead of being copied when the transaction is created, since most transactions are discarded after
+    testing one or two of them. Creating a Transaction returns a TransactionV1 or TransactionV3 depending on the
+    version, each with accessors for the field names of that version.
     """
+    __slots__ = ("db", "tested", "successful", "raw_transaction", "blockheight", "blocktimestamp")
+
+    # Transaction attribute -> key in the transaction dict, for the fields at its top level. Set for each version.
+    KEYS = {}
+
+    def __new__(cls, transaction: dict, *args, **kwargs) -> Transaction:
+        if cls is Transaction:
+            cls = transaction_class(transaction)
+        return object.__new__(cls)
+
     def __init__(self, transaction: dict, db: Leveldb, blockheight = None, blocktimestamp = None) -> Transaction:
         self.db = db
         self.tested = False
         self.successful = None
         self.raw_transaction = transaction
+        self.blockheight = blockheight or None
+        self.blocktimestamp = blocktimestamp or None
 
-        # Set blockheight and block_timestamp.
-        if blockheight:
-            self.blockheight = blockheight
-        else:
-            self.blockheight = None
-        
-        if blocktimestamp:
-            self.blocktimestamp = blocktimestamp
-        else:
-            self.blocktimestamp = None
-
-        # Set transaction version.
-        try:
-            self.version = transaction['version']
-        except KeyError:
-            self.version = "0x1"
-
-        # Initialize transaction based on different versions.
-        if self.version == "0x1":
-            self.parse_v1()
+    def __getnewargs__(self) -> tuple:
+        # For pickling, __new__ needs the transaction to pick the class.
+        return (self.raw_transaction,)
 
-        elif self.version == "0x3":
-            self.parse_v3()
-        
-        else:
-            raise Exception(f"{self.version} not handled by class.")
+    @property
+    def version(self) -> str:
+        return self.raw_transaction.get('version', "0x1")
 
-    def parse_v1(self):
-        """
-        Parse version 1 transactions.
-        """
-        try:
-            self.from_ = self.raw_transaction['from']
-        except KeyError:
-            self.from_ = None
-            
-        try: 
-            self.to = self.raw_transaction['to']
-        except KeyError:
-            self.to = None
+    @property
+    def from_(self) -> str:
+        return self.raw_transaction.get('from')
 
-        try:
-            self.value = self.raw_transaction['value']
-        except KeyError:
-            self.value = None
+    @property
+    def to(self) -> str:
+        return self.raw_transaction.get('to')
 
-        self.datatype = None
-        self.data = None
-                
-        try:
-            self.method = self.raw_transaction['data']['method']
-        except KeyError:
-            self.method = None
+    @property
+    def value(self) -> str:
+        return self.raw_transaction.get('value')
 
-        try:
-            self.params = self.raw_transaction['data']['params']
-        except KeyError:
-            self.params = None
+    @property
+    def method(self) -> str:
+        return data_field(self.raw_transaction, 'method')
 
-        try:
-            self.txhash = self.raw_transaction['tx_hash']
-        except KeyError:
-            self.txhash = None
+    @property
+    def params(self) -> dict:
+        return data_field(self.raw_transaction, 'params')
 
-    def parse_v3(self):
+    @classmethod
+    def getter(cls, attribute: str):
         """
-        Parse version 3 transactions.
+        Return a function reading attribute from a transaction dict of this version,
+        for testing fields before a Transaction is created.
         """
-        try:
-            self.from_ = self.raw_transaction['from']
-        except KeyError:
-            self.from_ = None
-
-        try: 
-            self.to = self.raw_transaction['to']
-        except KeyError:
-            self.to = None
-        
-        try:
-            self.value = self.raw_transaction['value']
-        except KeyError:
-            self.value = None
-        
-        try:
-            self.datatype = self.raw_transaction['dataType']
-        except KeyError:
-            self.datatype = None
-        
-        try:
-            self.data = self.raw_transaction['data']
-        except KeyError:
-            self.data = None
-
-        try:
-            self.method = self.raw_transaction['data']['method']
-        except (KeyError, TypeError):
-            self.method = None
-    
-        try:
-            self.params = self.raw_transaction['data']['params']
-        except (KeyError, TypeError):
-            self.params = None
-
-        try:
-            self.txhash = self.raw_transaction['txHash']
-        except KeyError:
-            self.txhash = None
+        if attribute in cls.KEYS:
+            return operator.methodcaller('get', cls.KEYS[attribute])
+        if attribute in ('method', 'params'):
+            return lambda transaction: data_field(transaction, attribute)
+        # Constant for the version.
+        value = getattr(cls, attribute)
+        return lambda transaction: value
 
     def convert_units(self) -> None:
         ##TODO
@@ -208,10 +386,17 @@ class Transaction:
         return False
 
     def was_successful(self) -> bool:
-        if self.get_transaction_result()['result']['status'] == "0x1":
-            return True
-        else:
-            return False
+        # Result is looked up once and then remembered.
+        if not self.tested:
+            self.set_successful(self.get_transaction_result())
+        return self.successful
+
+    def set_successful(self, txresult: dict) -> None:
+        """
+        Set the success status from a transaction result.
+        """
+        self.successful = txresult['result']['status'] == "0x1"
+        self.tested = True
 
     def fulfills_criteria(self, from_ = None, to = None, datatypes = None,
                           methods = None, params = None) -> bool:
@@ -234,7 +419,7 @@ class Transaction:
         
     def get_transaction(self):
         return {"block": self.blockheight, "from": self.from_, "to": self.to, "value": self.value, "datatype": self.datatype,
-                "data": self.data, "txhash": self.txhash, "blocktimestamp": self.blocktimestamp}
+                "data": self.data, "txhash": self.txhash, "blocktimestamp": self.blocktimestamp, "method": self.method}
     
     def get_transaction_result(self):
         """
@@ -243,3 +428,150 @@ class Transaction:
            txresult (dict) - transaction result
         """
         return json.loads(self.db.get(self.txhash.encode()))
+
+
+class TransactionV1(Transaction):
+    """
+    Version 1 transactions, from blocks before Block.V3_BLOCK_HEIGHT. They have no datatype.
+    """
+    __slots__ = ()
+
+    KEYS = {"from_": "from", "to": "to", "value": "value", "txhash": "tx_hash"}
+
+    datatype = None
+    data = None
+
+    @property
+    def txhash(self) -> str:
+        return self.raw_transaction.get('tx_hash')
+
+
+class TransactionV3(Transaction):
+    """
+    Version 3 transactions.
+    """
+    __slots__ = ()
+
+    KEYS = {"from_": "from", "to": "to", "value": "value", "datatype": "dataType", "data": "data", "txhash": "txHash"}
+
+    @property
+    def datatype(self) -> str:
+        return self.raw_transaction.get('dataType')
+
+    @property
+    def data(self):
+        return self.raw_transaction.get('data')
+
+    @property
+    def txhash(self) -> str:
+        return self.raw_transaction.get('txHash')
+
+
+# Transaction version -> class.
+VERSIONS = {"0x1": TransactionV1, "0x3": TransactionV3}
+
+
+def transaction_class(transaction: dict) -> type:
+    """
+    Return the Transaction class for the version of a transaction dict.
+    """
+    version = transaction.get('version', "0x1")
+    try:
+        return VERSIONS[version]
+    except KeyError:
+        raise Exception(f"{version} not handled by class.") from None
+
+
+def data_field(transaction: dict, name: str):
+    """
+    Return a field of the data of a call transaction, None if there is no such field.
+    """
+    data = transaction.get('data')
+    return data.get(name) if isinstance(data, dict) else None
+
+
+class ReceiptCache:
+    """
+    Bounded LRU cache of transaction success statuses, keyed by txhash.
+    Used for resolving the success of all matched transactions in a block in one go.
+    """
+
+    def __init__(self, db: Leveldb, size: int = 0, stats: Stats = None) -> ReceiptCache:
+        """
+        Input:
+            db (Leveldb)  - blockchain database.
+            size (int)    - maximum number of statuses kept. 0 disables caching.
+            stats (Stats) - records lookup times and cache hits if given.
+        """
+        self.db = db
+        self.size = size
+        self.stats = stats
+        self.statuses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, transactions: list) -> None:
+        """
+        Set the success status on every transaction not already tested.
+        Cached statuses are used where possible and the rest are read from the database together.
+        """
+        lookups = []
+        hits = self.hits
+        for transaction in transactions:
+            if transaction.tested:
+                continue
+            successful = self.statuses.get(transaction.txhash)
+            if successful is None:
+                lookups.append(transaction)
+                continue
+            self.statuses.move_to_end(transaction.txhash)
+            transaction.successful = successful
+            transaction.tested = True
+            self.hits += 1
+
+        if self.stats:
+            self.stats.count("receipt_hits", self.hits - hits)
+            self.stats.count("receipt_misses", len(lookups))
+        if not lookups:
+            return
+
+        for transaction, txresult in zip(lookups, self.fetch([transaction.txhash for transaction in lookups])):
+            transaction.set_successful(txresult)
+            self.misses += 1
+            self.add(transaction.txhash, transaction.successful)
+
+    def fetch(self, txhashes: list) -> list:
+        """
+        Read and decode transaction results.
+        Sources that can fetch many results in one go, like RpcSource, provide get_results.
+        """
+        clock = timer(self.stats)
+        if hasattr(self.db, "get_results"):
+            txresults = self.db.get_results(txhashes)
+            clock.lap("receipt_get")
+            return txresults
+
+        results = []
+        with self.db.snapshot() as snapshot:
+            clock.start()
+            for txhash in txhashes:
+                results.append(snapshot.get(txhash.encode()))
+                clock.lap("receipt_get")
+
+        txresults = []
+        clock.start()
+        for txresult in results:
+            txresults.append(json.loads(txresult))
+            clock.lap("receipt_loads")
+        return txresults
+
+    def add(self, txhash: str, successful: bool) -> None:
+        """
+        Add a status to the cache and evict the least recently used if full.
+        """
+        if not self.size:
+            return
+        self.statuses[txhash] = successful
+        self.statuses.move_to_end(txhash)
+        if len(self.statuses) > self.size:
+            self.statuses.popitem(last = False)
@@ -0,0 +1,210 @@
+from __future__ import annotations
+from blockchain import Block
+from blockchain import ReceiptCache
+from blockchain import Transaction
+from rules import RuleIndex
+from stats import timer
+import time
+
+
+class Matcher:
+    """
+    Tests the transactions of a block against the rules of a list of files.
+    Holds no database handle or open files, so it can be shipped to worker processes.
+    """
+
+    def __init__(self, rules: list, stats: Stats = None) -> Matcher:
+        self.rules = rules
+        self.index = RuleIndex(rules)
+        self.stats = stats
+
+    def match(self, block: Block, db: Leveldb = None) -> list:
+        """
+        Test each transaction in block against the rules.
+        With stats, transaction parsing and rule testing are timed separately.
+        Input:
+            block (Block) - parsed block.
+            db (Leveldb)  - database handle given to the transactions, can be None.
+        Return:
+            matches (list) - (transaction, [rule indices]) for every transaction matching at least one rule.
+        """
+        index = self.index
+        clock = timer(self.stats)
+        matches = []
+        clock.start()
+        for transaction in block.transactions:
+            # Transactions are only created for the ones some file could match.
+            candidates = index.candidates(transaction)
+            if not candidates:
+                clock.lap("match")
+                continue
+            looked_up = clock.split()
+            transaction = Transaction(transaction, db, block.height, block.timestamp)
+            clock.lap("transaction")
+
+            targets = index.match(transaction, candidates)
+            clock.lap("match", looked_up)
+            if targets:
+                matches.append((transaction, targets))
+        clock.count("transactions", len(block.transactions))
+        clock.count("matched_transactions", len(matches))
+        return matches
+
+
+class Extractor:
+    """
+    Extracts transactions from blocks into a list of TxFiles
+    according to the rules of each file.
+    """
+
+    def __init__(self, txfiles: list, db: Leveldb, receipt_cache_size: int = 0,
+                 writer: AsyncWriter = None, stats: Stats = None) -> Extractor:
+        """
+        Input:
+            txfiles (list)           - open TxFiles with rules set.
+            db (Leveldb)             - blockchain database.
+            receipt_cache_size (int) - size of the transaction status cache, 0 disables it.
+            writer (AsyncWriter)     - writes to the files in the background if given.
+            stats (Stats)            - records stage times if given.
+        """
+        self.txfiles = txfiles
+        self.db = db
+        self.writer = writer
+        self.stats = stats
+        self.matcher = Matcher([txfile.rules for txfile in txfiles], stats)
+        self.receipts = ReceiptCache(db, receipt_cache_size, stats)
+
+    def process(self, block: Block) -> None:
+        """
+        Match all transactions in block and write the matching ones to file.
+        """
+        clock = timer(self.stats)
+        self.commit(self.matcher.match(block, self.db))
+        clock.lap("block")
+        clock.count("blocks")
+
+    def commit(self, matches: list) -> None:
+        """
+        Write matched transactions to their files.
+        Transactions are checked for success here, after matching, for the files that requires it.
+        The results for all those transactions are looked up together.
+        Input:
+            matches (list) - output from Matcher.match.
+        """
+        untested = []
+        for transaction, targets in matches:
+            if transaction.db is None:
+                transaction.db = self.db
+            for i in targets:
+                if not self.txfiles[i].include_failed_tx:
+                    untested.append(transaction)
+                    break
+        self.receipts.resolve(untested)
+
+        rows = []
+        for transaction, targets in matches:
+            for i in targets:
+                txfile = self.txfiles[i]
+                if not txfile.include_failed_tx:
+                    if not transaction.was_successful():
+                        continue
+
+                # Write to file if all tests passed
+                rows.append((txfile, transaction.get_transaction()))
+                txfile.transactions += 1
+
+        if not rows:
+            return
+        clock = timer(self.stats)
+        clock.count("rows", len(rows))
+        if self.writer:
+            self.writer.append(rows)
+            clock.lap("writer_wait")
+        else:
+            for txfile, tx in rows:
+                txfile.append_transaction(tx)
+            clock.lap("write")
+
+
+class Checkpointer:
+    """
+    Saves the progress of an extraction every n blocks or seconds, whichever comes first.
+    A checkpoint writes everything queued, syncs every file and saves lastblock and
+    the file offsets to the configuration file. Opening a file again removes anything
+    written after its last checkpoint, so a crashed run can be resumed with update.
+    """
+
+    def __init__(self, txfiles: list, registry: Registry, writer: AsyncWriter = None,
+                 blocks: int = 0, seconds: float = 0, stats: Stats = None) -> Checkpointer:
+        """
+        Input:
+            txfiles (list)       - open TxFiles.
+            registry (Registry)  - configuration the files belong to.
+            writer (AsyncWriter) - writer to flush before syncing, if used.
+            blocks (int)         - blocks between checkpoints, 0 disables.
+            seconds (float)      - seconds between checkpoints, 0 disables.
+            stats (Stats)        - records checkpoint times if given.
+        """
+        self.txfiles = txfiles
+        self.registry = registry
+        self.writer = writer
+        self.blocks = blocks
+        self.seconds = seconds
+        self.stats = stats
+        self.counter = 0
+        self.last = time.time()
+
+    def due(self) -> bool:
+        """
+        Count a processed block and test if it's time for a checkpoint.
+        """
+        self.counter += 1
+        if self.blocks and self.counter >= self.blocks:
+            return True
+        if self.seconds and time.time() - self.last >= self.seconds:
+            return True
+        return False
+
+    def save(self) -> None:
+        """
+        Save a checkpoint. lastblock of each file must be set first.
+        """
+        start = time.perf_counter()
+        if self.writer:
+            self.writer.flush()
+        for txfile in self.txfiles:
+            txfile.checkpoint()
+        self.registry.save(self.txfiles)
+        self.counter = 0
+        self.last = time.time()
+        if self.stats:
+            self.stats.add("checkpoint", time.perf_counter() - start)
+
+
+class Segment:
+    """
+    A block interval to extract and the files to extract it to.
+    """
+
+    def __init__(self, firstblock: int, lastblock: int, txfiles: list) -> Segment:
+        self.firstblock = firstblock
+        self.lastblock = lastblock
+        self.txfiles = txfiles
+
+
+def schedule(txfiles: list, lastblock: int) -> list:
+    """
+    Plan how to bring files at different heights up to lastblock.
+    The files furthest behind are extracted alone until they reach the next group of files,
+    then the groups continue together, until all files reach lastblock.
+    Files already at or past lastblock are left out.
+    Return:
+        segments (list) - consecutive Segments, each with the files of all earlier segments and more.
+    """
+    heights = sorted({txfile.lastblock for txfile in txfiles if txfile.lastblock < lastblock})
+    segments = []
+    for i, height in enumerate(heights):
+        stop = heights[i + 1] if i + 1 < len(heights) else lastblock
+        active = [txfile for txfile in txfiles if txfile.lastblock <= height]
+        segments.append(Segment(height + 1, stop, active))
+    return segments
@@ -0,0 +1,72 @@
+from __future__ import annotations
+from blockchain import Block
+from mapped import MappedFile
+
+
+class BlockHashes(MappedFile):
+    """
+    Memory mapped array of block hashes indexed by height, so the hash of a block is found without
+    a database lookup. Each hash takes 32 bytes, an all zero slot is a height not in the array.
+    The first slot is a header holding the last height added.
+
+    Built from the block height keys of the blockchain database and extended with new blocks by extend.
+    The database stores hashes as 64 character hex strings, which are converted back on lookup.
+    """
+    WIDTH = 32
+    EMPTY = bytes(WIDTH)
+
+    def __init__(self, path: str) -> BlockHashes:
+        MappedFile.__init__(self, path)
+
+    @property
+    def lastheight(self) -> int:
+        """
+        Last height added, -1 if empty.
+        """
+        if not self.size:
+            return -1
+        return int.from_bytes(self.mm[:8], byteorder = 'big', signed = True)
+
+    def get(self, height: int) -> bytes:
+        """
+        Return the block hash of height as stored in the database, None if not in the array.
+        """
+        if height > self.lastheight or height < 0:
+            return None
+        offset = (height + 1) * self.WIDTH
+        value = self.mm[offset:offset + self.WIDTH]
+        if value == self.EMPTY:
+            return None
+        return value.hex().encode()
+
+    def extend(self, db: Leveldb) -> int:
+        """
+        Add the hashes of blocks after lastheight, reading the block height keys in order.
+        Return:
+            added (int) - number of hashes added.
+        """
+        keylen = len(Block.BLOCK_HEIGHT_KEY) + Block.BLOCK_HEIGHT_BYTES_LEN
+        start = Block.height_key(self.lastheight + 1)
+        stop = Block.BLOCK_HEIGHT_KEY + b'\xff' * Block.BLOCK_HEIGHT_BYTES_LEN
+        added = 0
+        last = self.lastheight
+        with db.iterator(start = start, stop = stop, fill_cache = False) as iterator:
+            for key, blockhash in iterator:
+                if len(key) != keylen:
+                    continue
+                height = int.from_bytes(key[len(Block.BLOCK_HEIGHT_KEY):], byteorder = 'big')
+                value = bytes.fromhex(blockhash.decode())
+                if len(value) != self.WIDTH or value.hex().encode() != blockhash:
+                    raise ValueError(f"Unexpected block hash format at height {height}: {blockhash!r}")
+
+                offset = (height + 1) * self.WIDTH
+                self.reserve(offset + self.WIDTH)
+                self.mm[offset:offset + self.WIDTH] = value
+                last = height
+                added += 1
+
+        if added:
+            self.reserve(self.WIDTH)
+            self.mm[:8] = last.to_bytes(8, byteorder = 'big', signed = True)
+            self.flush()
+        return added
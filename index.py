@@ -0,0 +1,122 @@
+from __future__ import annotations
+from blockchain import Transaction
+import os
+import sqlite3
+
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql", "index.sql")
+
+
+class BlockIndex:
+    """
+    Persistent index from to, from, method and datatype to the blocks
+    (and position in block) of the transactions having them.
+    Used for only reading the blocks that can match sparse rules.
+    """
+    # Rule name -> (index field, transaction attribute).
+    FIELDS = {"to": ("to", "to"), "from_": ("from", "from_"),
+              "methods": ("method", "method"), "datatypes": ("datatype", "datatype")}
+
+    # Reading blocks one by one is slower than scanning a range, so the index is only used
+    # if it leaves at most this share of the blocks it covers to read.
+    MAX_SHARE = 0.5
+
+    def __init__(self, path: str) -> BlockIndex:
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        with open(SCHEMA, 'r') as schema:
+            self.connection.executescript(schema.read())
+
+    @property
+    def lastblock(self) -> int:
+        """
+        Last block included in the index, 0 if empty.
+        """
+        row = self.connection.execute("SELECT value FROM index_state WHERE key = 'lastblock'").fetchone()
+        return row[0] if row else 0
+
+    def clear(self) -> None:
+        """
+        Remove everything from the index.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM postings")
+            self.connection.execute("DELETE FROM index_state")
+
+    def add_blocks(self, blocks: list) -> None:
+        """
+        Add the transactions of consecutive blocks to the index and
+        move lastblock to the last of them, in one database transaction.
+        """
+        rows = []
+        for block in blocks:
+            for ordinal, transaction in enumerate(block.transactions):
+                transaction = Transaction(transaction, None)
+                for field, attribute in self.FIELDS.values():
+                    value = getattr(transaction, attribute)
+                    if value is not None:
+                        rows.append((field, value, block.height, ordinal))
+
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO postings VALUES (?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO index_state VALUES ('lastblock', ?)",
+                                    (blocks[-1].height,))
+
+    @classmethod
+    def covers(cls, rules: dict) -> bool:
+        """
+        Test if every filter of a rule set is indexed.
+        Rule sets without any filter match every block and are not covered.
+        """
+        if rules.get("params"):
+            return False
+        return any(rules.get(name) for name in cls.FIELDS)
+
+    def blocks(self, rules: dict, firstblock: int, lastblock: int) -> set:
+        """
+        Return the blocks in firstblock - lastblock that can hold transactions matching rules.
+        """
+        blocks = None
+        for name, (field, attribute) in self.FIELDS.items():
+            values = rules.get(name)
+            if not values:
+                continue
+            values = list(values)
+            found = set()
+            # Stay below sqlite's limit on query parameters.
+            for i in range(0, len(values), 500):
+                chunk = values[i:i + 500]
+                query = (f"SELECT DISTINCT block FROM postings WHERE field = ? AND block BETWEEN ? AND ? "
+                         f"AND value IN ({', '.join('?' * len(chunk))})")
+                found.update(row[0] for row in self.connection.execute(query, [field, firstblock, lastblock] + chunk))
+            blocks = found if blocks is None else blocks & found
+        return blocks
+
+    def heights(self, rules: list, firstblock: int, lastblock: int) -> list:
+        """
+        Plan which blocks to read for a list of rule sets.
+        Return:
+            parts (list) - sorted list of the heights to read in the blocks covered by the index, followed by
+                           a range of the blocks after the end of the index, if any. None if some rule set
+                           can't be answered by the index or the index doesn't cover enough to save reads.
+        """
+        if not all(self.covers(file_rules) for file_rules in rules):
+            return None
+
+        indexed = min(lastblock, self.lastblock)
+        if indexed < firstblock:
+            return None
+        heights = set()
+        for file_rules in rules:
+            heights |= self.blocks(file_rules, firstblock, indexed)
+        if len(heights) > (indexed - firstblock + 1) * self.MAX_SHARE:
+            return None
+
+        parts = [sorted(heights)]
+        if indexed < lastblock:
+            parts.append(range(indexed + 1, lastblock + 1))
+        return parts
+
+    def close(self) -> None:
+        self.connection.close()
@@ -1,18 +1,36 @@
+from __future__ import annotations
 import argparse
-import configparser
 from blockchain import Block
 from blockchain import Transaction
+from blockchain import stream_blocks
 import csv
+from extractor import Checkpointer
+from extractor import Extractor
+from extractor import schedule
+from hashes import BlockHashes
+from index import BlockIndex
+from metrics import Metrics
 import json
-import plyvel
 import signal
 import time
+import threading
 from threading import Timer, Thread
 import datetime
 import os
+import shutil
 import sys
-from tqdm import tqdm
+from registry import Registry
+from rules import Prefilter
+from rules import RuleError
+from rules import RuleIndex
+from rules import compile_where
+from stats import Stats
+from timestamps import TimestampIndex
+from timestamps import parse_time
+from txfile import FilePool
 from txfile import TxFile
+from writer import AsyncWriter
+from parallel import parallel_matches
 
 
 COLUMNS = ["block", "from", "to", "value", "datatype", "data", "txhash", "blocktimestamp"]
@@ -21,12 +39,49 @@ CONFIG = "./itx.ini"
 
 
 #Get default arguments from file.
-config = configparser.ConfigParser()
-config.read(CONFIG)
-df_args = dict(config['DEFAULT'])
+registry = Registry(CONFIG)
+df_args = registry.defaults()
 
 OUTPUT = df_args['output']
 LEVELDB = df_args['leveldb']
+INDEX = df_args.get('index', 'data/index.db')
+TIMESTAMPS = df_args.get('timestamps', 'data/timestamps.bin')
+BLOCK_HASHES = df_args.get('block_hashes', 'data/block_hashes.bin')
+INDEX_BATCH = 1000
+PREFETCH_DEPTH = int(df_args.get('prefetch_depth', 64))
+PREFETCH_WORKERS = int(df_args.get('prefetch_workers', 2))
+RECEIPT_CACHE_SIZE = int(df_args.get('receipt_cache_size', 0))
+SQLITE_BATCH_SIZE = int(df_args.get('sqlite_batch_size', 1000))
+PARQUET_ROW_GROUP_SIZE = int(df_args.get('parquet_row_group_size', 100000))
+WRITER_QUEUE_DEPTH = int(df_args.get('writer_queue_depth', 1000))
+FSYNC_INTERVAL = float(df_args.get('fsync_interval', 0))
+CHECKPOINT_BLOCKS = int(df_args.get('checkpoint_blocks', 0))
+CHECKPOINT_INTERVAL = float(df_args.get('checkpoint_interval', 0))
+OUTPUT_OPEN_FILES = int(df_args.get('output_open_files', 256))
+OUTPUT_BUFFER_ROWS = int(df_args.get('output_buffer_rows', 1000))
+METRICS_FILE = df_args.get('metrics_file') or None
+METRICS_PORT = int(df_args['metrics_port']) if df_args.get('metrics_port') else None
+METRICS_INTERVAL = float(df_args.get('metrics_interval', 5))
+
+# Block source, leveldb or rpc.
+SOURCE = df_args.get('source', 'leveldb')
+RPC_URL = df_args.get('rpc_url', 'https://ctz.solidwallet.io/api/v3')
+RPC_BATCH_SIZE = int(df_args.get('rpc_batch_size', 100))
+RPC_CONCURRENCY = int(df_args.get('rpc_concurrency', 8))
+RPC_RETRIES = int(df_args.get('rpc_retries', 5))
+RPC_TIMEOUT = float(df_args.get('rpc_timeout', 30))
+RPC_CACHE = df_args.get('rpc_cache') or None
+RPC_CACHE_SIZE = int(df_args.get('rpc_cache_size') or 0)
+
+# Leveldb read options.
+SCAN = registry.config.getboolean('DEFAULT', 'leveldb_scan', fallback = True)
+FILL_CACHE = registry.config.getboolean('DEFAULT', 'leveldb_fill_cache', fallback = False)
+PREFILTER = registry.config.getboolean('DEFAULT', 'prefilter', fallback = True)
+LEVELDB_OPTIONS = {}
+if df_args.get('leveldb_cache_size'):
+    LEVELDB_OPTIONS['lru_cache_size'] = int(df_args['leveldb_cache_size'])
+if df_args.get('leveldb_max_open_files'):
+    LEVELDB_OPTIONS['max_open_files'] = int(df_args['leveldb_max_open_files'])
 
 def main():
     
@@ -57,7 +112,8 @@ def main():
     optional_init = parser_initialize.add_argument_group('optional arguments')
     
     required_init.add_argument('--file', type = str, required = True, metavar = "<file>",
-                                help = "Filename for transaction storage. Csv file.")
+                                help = "Filename for transaction storage. Csv file, a .db file with --format sqlite "
+                                       "or a .parquet directory with --format parquet.")
     
     optional_init.add_argument('--from', metavar = '<addr>', type = str, nargs = "+", dest = "from_",
                                 action = CustomAction1, default = [], 
@@ -78,9 +134,25 @@ def main():
     optional_init.add_argument('--params', metavar = '<paramaters>', type = str, nargs = "+", 
                                 help = 'Parameters in method call.', default = [])
 
+    optional_init.add_argument('--where', metavar = '<expression>', type = str, action = 'append', default = [],
+                                help = "Condition on the transaction, e.g. \"value > 1000 icx\" or "
+                                       "\"sum(params.delegations.*.value) >= 10000 icx and not from == hx...\". "
+                                       "Can be given more than once, all conditions must hold. "
+                                       "See the README for the syntax.")
+
     optional_init.add_argument('--columns', choices = COLUMNS, type = str, nargs = "+",
                                    help = 'Table structure in file.', default = COLUMNS)
 
+    optional_init.add_argument('--format', choices = list(TxFile.FORMATS), type = str, default = "csv",
+                                help = "Output format. Default is csv. With sqlite the transactions are inserted into "
+                                       "a table in a sqlite database, duplicate transactions are ignored. "
+                                       "With parquet each extraction adds a part file to a directory of parquet files "
+                                       "(requires pyarrow).")
+
+    optional_init.add_argument('--table', metavar = '<table>', type = str,
+                                help = "Table for sqlite output. Can be one of the tables in sql/schema.sql. "
+                                       "Default is the filename without extension.")
+
     optional_init.add_argument('--include-failed-transactions', action = 'store_true', dest = "include_failed_tx",
                                 help = "By default only successful transactions are extracted. "
                                        "With this option there will be no test if transactions where successful or not. "
@@ -106,11 +178,32 @@ def main():
     required_extract.add_argument('--files', type = str, required = True, nargs = "+", metavar =  "<files>",
                                 help = "File to store extracted transactions in.")
     
-    required_extract.add_argument('--first-block', type = int, metavar = "<block>", required = True, dest = "firstblock",
+    first_extract = required_extract.add_mutually_exclusive_group(required = True)
+    first_extract.add_argument('--first-block', type = int, metavar = "<block>", dest = "firstblock",
                                 help = 'First block to extraction from.')
 
-    required_extract.add_argument('--last-block', type = int, metavar = "<block>", required = True, dest = "lastblock",
+    first_extract.add_argument('--since', type = parse_time, metavar = "<time>",
+                                help = "Extract from the first block at or after this time, instead of --first-block. "
+                                       "A date or date and time in ISO format, e.g. 2021-03-01T12:00, "
+                                       "in UTC unless a timezone is given, or seconds since epoch.")
+
+    last_extract = required_extract.add_mutually_exclusive_group(required = True)
+    last_extract.add_argument('--last-block', type = int, metavar = "<block>", dest = "lastblock",
                                 help = "Last block to extract from.")
+
+    last_extract.add_argument('--until', type = parse_time, metavar = "<time>",
+                                help = "Extract up to the last block before this time, instead of --last-block. "
+                                       "Same format as --since.")
+
+    optional_extract.add_argument('--workers', type = int, metavar = "<n>", default = 1,
+                                help = "Number of worker processes used for decoding and matching blocks. "
+                                       "Default is 1, which runs the extraction in a single process.")
+
+    optional_extract.add_argument('--stats', action = 'store_true',
+                                help = "Time each stage of the extraction and print a report at the end.")
+
+    optional_extract.add_argument('--stats-json', type = str, metavar = "<file>", dest = "stats_json",
+                                help = "Time each stage of the extraction and write the report to this json file.")
     
     parser_extract.set_defaults(func = extract)
 
@@ -131,13 +224,74 @@ def main():
     parser_update.add_argument('--last-block', type = int, metavar = "<block>", dest = "lastblock",
                                 help = 'Update files up to this block.')    
 
+    parser_update.add_argument('--stats', action = 'store_true',
+                                help = "Time each stage of the update and print a report at the end.")
+
+    parser_update.add_argument('--stats-json', type = str, metavar = "<file>", dest = "stats_json",
+                                help = "Time each stage of the update and write the report to this json file.")
+
     parser_update.set_defaults(func = update)
 
-#    # Create parser for syncronize command.
-#    parser_syncronize = subparsers.add_parser('syncronize',
-#                                              usage='python3 itx.py syncronize [options] <file>',
-#                                              help='Keep files syncronized via RPC.',
-#                                              add_help=True)
+    # Create parser for index command.
+    parser_index = subparsers.add_parser('index',
+                                         usage = 'python3 itx.py index <command> <arguments>',
+                                         help = 'Build or update the block index. When all rules of the extracted files '
+                                                'only filter on to, from, methods and datatypes, extract and update '
+                                                'use the index to only read blocks that can match.',
+                                         add_help = True)
+
+    index_subparsers = parser_index.add_subparsers(title = "commands", dest = "index_command", required = True)
+
+    parser_index_build = index_subparsers.add_parser('build',
+                                                     usage = 'python3 itx.py index build <arguments>',
+                                                     help = 'Build the index from the first block.',
+                                                     add_help = True)
+
+    parser_index_build.add_argument('--last-block', type = int, metavar = "<block>", dest = "lastblock",
+                                    help = 'Index up to this block. Default is the last block in the database.')
+
+    parser_index_build.set_defaults(func = index)
+
+    parser_index_update = index_subparsers.add_parser('update',
+                                                      usage = 'python3 itx.py index update <arguments>',
+                                                      help = 'Extend the index with new blocks.',
+                                                      add_help = True)
+
+    parser_index_update.add_argument('--last-block', type = int, metavar = "<block>", dest = "lastblock",
+                                     help = 'Index up to this block. Default is the last block in the database.')
+
+    parser_index_update.set_defaults(func = index)
+
+    # Create parser for hashes command.
+    parser_hashes = subparsers.add_parser('hashes',
+                                          usage = 'python3 itx.py hashes',
+                                          help = 'Build or update the block hash array, so extract, update, follow and '
+                                                 'index find block hashes without a database lookup.',
+                                          add_help = True)
+
+    parser_hashes.set_defaults(func = build_hashes)
+
+    # Create parser for follow command.
+    parser_follow = subparsers.add_parser('follow',
+                                          usage = 'python3 itx.py follow <arguments>',
+                                          help = 'Keep files up to date. Checks for new blocks every interval seconds '
+                                                 'and extracts them, until stopped with ctrl + c. Files must have '
+                                                 'been extracted before.',
+                                          add_help = True)
+
+    parser_follow.add_argument('--files', type = str, required = True, nargs = "+",
+                                help = "Files to keep up to date.")
+
+    parser_follow.add_argument('--interval', type = float, metavar = "<seconds>", default = 10,
+                                help = "Seconds between checks for new blocks. Default is 10.")
+
+    parser_follow.add_argument('--stats', action = 'store_true',
+                                help = "Time each stage and print a report when stopped.")
+
+    parser_follow.add_argument('--stats-json', type = str, metavar = "<file>", dest = "stats_json",
+                                help = "Time each stage and write the report to this json file when stopped.")
+
+    parser_follow.set_defaults(func = follow)
 
 
     # Create parser for remove command.
@@ -177,9 +331,22 @@ def initialize(args):
     	os.makedirs(OUTPUT)
 
     # Check if filetype specified.
-    if not args.file.endswith(".csv"):
-        print("Did you forget to specify filetype? Only .csv files are supported.")
+    extensions = TxFile.FORMATS[args.format]
+    if not args.file.endswith(extensions):
+        print(f"Did you forget to specify filetype? Supported filetypes for {args.format}: {' '.join(extensions)}")
         sys.exit(1)
+
+    table = None
+    if args.format == "sqlite":
+        table = args.table or os.path.splitext(args.file)[0]
+
+    # Check where expressions before anything is written.
+    for expression in args.where:
+        try:
+            compile_where(expression)
+        except RuleError as error:
+            print(error)
+            sys.exit(1)
     
     # Handle file already exists.
     filepath = OUTPUT + args.file
@@ -187,7 +354,10 @@ def initialize(args):
         while True:
             response = input(f"{args.file} already exists. Overwrite? (Y/n): ")
             if response in ["Y", "y", ""]:
-                os.remove(filepath)
+                if os.path.isdir(filepath):
+                    shutil.rmtree(filepath)
+                else:
+                    os.remove(filepath)
                 break
             
             elif response in ["N", "n"]:
@@ -198,160 +368,397 @@ def initialize(args):
                 continue
     
     # Initialize txfile with its extraction settings.
-    txfile = TxFile(name = args.file, folder = OUTPUT, inifile = CONFIG, from_ = args.from_,
+    txfile = registry.txfile(name = args.file, folder = OUTPUT, from_ = args.from_,
                     to = args.to, datatypes = args.datatypes, methods = args.methods, params = args.params,
-                    columns = args.columns, include_failed_tx = args.include_failed_tx)
+                    where = args.where,
+                    columns = args.columns, include_failed_tx = args.include_failed_tx,
+                    format = args.format, table = table, batch_size = SQLITE_BATCH_SIZE,
+                    row_group_size = PARQUET_ROW_GROUP_SIZE)
    
-    # Save settings to configuration file.
-    txfile.delete_config()
-    txfile.save_config()
+    # Save settings to configuration file, before the file is created so it's never left untracked.
+    registry.save([txfile], removed = [txfile.name])
 
-    # Create file and write header row to file.
+    # Create file and write header row to file, and save the offset after the header.
     txfile.create_file()
     txfile.open('w')
     txfile.write_header_row()
     txfile.close()
+    registry.save([txfile])
 
 def extract(args):
+    from tqdm import tqdm
+
+    # Open local blockchaindb.
+    plyveldb = open_db()
+
+    # Find the blocks of --since and --until.
+    if args.since is not None or args.until is not None:
+        resolve_times(args, plyveldb)
+        if args.firstblock > args.lastblock:
+            print("No blocks in the given time range.")
+            plyveldb.close()
+            return
 
     # Ignore genesisblock.
     if args.firstblock == 0:
         args.firstblock = 1
         print("- Genesisblock ignored.")
-
-    # Open local blockchaindb.
-    plyveldb = plyvel.DB(LEVELDB, create_if_missing = False)
     
     # Prepare list of TxFile objects.
+    pool = FilePool(OUTPUT_OPEN_FILES, OUTPUT_BUFFER_ROWS)
     txfiles = []
     for file in args.files:
-        txfile = TxFile(name = file, inifile = CONFIG)
-        txfile.load_config()
+        txfile = registry.load(file)
         txfile.firstblock = args.firstblock
         txfile.set_rules()
-        txfile.open('a')
+        txfile.open('a', pool)
         txfiles.append(txfile)
 
     print("Extracting transactions...")
     
     # Extract all transactions form each block.
-    loop_broken = False
-    counter = -1
+    # lastblock is the last block that has been fully processed.
+    stats = start_stats(args)
+    writer = start_writer(stats)
+    extractor = Extractor(txfiles, plyveldb, receipt_cache_size = RECEIPT_CACHE_SIZE, writer = writer, stats = stats)
+    checkpointer = Checkpointer(txfiles, registry, writer, blocks = CHECKPOINT_BLOCKS, seconds = CHECKPOINT_INTERVAL,
+                                stats = stats)
+    metrics = start_metrics(txfiles, writer)
+    if metrics:
+        metrics.tip = last_height(plyveldb)
+        metrics.receipts = extractor.receipts
+    hashes = open_hashes(plyveldb)
+    lastblock = args.firstblock - 1
     flag = GracefulExiter()
-    for block in tqdm(range(args.firstblock, args.lastblock + 1), mininterval = 1, unit = "blocks"):
-        try:
-            block = Block(block, plyveldb)
-        except TypeError:
-            loop_broken = True
-            break
-        transactions = block.transactions
-        
-        # Test each transaction against rules.
-        for transaction in transactions:
-            transaction = Transaction(transaction, plyveldb, blockheight = block.height, blocktimestamp = block.timestamp)
-            
-            for txfile in txfiles:    
-                if not transaction.fulfills_criteria(**txfile.rules):
-                    continue
-
-                if not txfile.include_failed_tx:
-                    if not transaction.was_successful():
-                        continue
-
-                # Write to file if all tests passed
-                txfile.append_transaction(transaction.get_transaction())
-                txfile.transactions += 1
-        
-        counter += 1
+    parts = plan_heights(txfiles, args.firstblock, args.lastblock)
+    workers = args.workers
+    if workers > 1 and SOURCE == "rpc":
+        print("- Worker processes are not used with the rpc source.")
+        workers = 1
+    elif workers > 1 and not isinstance(parts[0], range):
+        print("- Worker processes are not used for the blocks read with the block index.")
+    progress = tqdm(total = sum(len(heights) for heights in parts), mininterval = 1, unit = "blocks")
+    for n, heights in enumerate(parts):
+        processed = 0
+        if workers > 1 and isinstance(heights, range) and heights:
+            rules = [txfile.rules for txfile in txfiles]
+            matches = parallel_matches(plyveldb, rules, heights[0], heights[-1], workers, stats = stats,
+                                       hashes = hashes, prefilter = PREFILTER, scan = SCAN, fill_cache = FILL_CACHE)
+            for height, block_matches in matches:
+                extractor.commit(block_matches)
+                lastblock = height
+                processed += 1
+                progress.update()
+                if metrics:
+                    metrics.processed(height)
+
+                if checkpointer.due():
+                    for txfile in txfiles:
+                        txfile.lastblock = lastblock
+                    checkpointer.save()
+
+                if flag.exit():
+                    break
+            matches.close()
+        else:
+            blocks = read_blocks(plyveldb, heights, stats, metrics, hashes, prefilter(txfiles), txfiles)
+            for block in blocks:
+                extractor.process(block)
+                lastblock = block.height
+                processed += 1
+                progress.update()
+                if metrics:
+                    metrics.processed(block.height, len(block.transactions))
+
+                if checkpointer.due():
+                    for txfile in txfiles:
+                        txfile.lastblock = lastblock
+                    checkpointer.save()
+
+                if flag.exit():
+                    break
+            blocks.close()
 
         if flag.exit():
             break
+        # Blocks skipped by the index are done as well.
+        if processed < len(heights):
+            lastblock = heights[processed] - 1
+            break
+        lastblock = parts[n + 1][0] - 1 if n + 1 < len(parts) else args.lastblock
+    progress.close()
+
+    if lastblock < args.lastblock and not flag.exit():
+        print(f"Block {lastblock + 1} not found in database. Ending extraction ...")
 
-    if loop_broken:
-        print(f"Block {block} not found in database. Ending extraction ...")
+    # Write queued transactions.
+    if writer:
+        writer.close()
 
     # Update config and close files 
     for txfile in txfiles:
-        txfile.lastblock = txfile.firstblock + counter
-        txfile.save_config()
-        txfile.close() 
+        txfile.lastblock = lastblock
+        txfile.close()
+    registry.save(txfiles)
     plyveldb.close()
+    if hashes:
+        hashes.close()
+    if metrics:
+        metrics.close()
+    report_stats(args, stats)
     
     if flag.exit():
         print("Exited gracefully.")
 
 def update(args):
+    from tqdm import tqdm
 
     # Open local leveldb blockchain database.
-    plyveldb = plyvel.DB(LEVELDB, create_if_missing = False)
+    plyveldb = open_db()
 
     # Prepare list of TxFile objects.
+    pool = FilePool(OUTPUT_OPEN_FILES, OUTPUT_BUFFER_ROWS)
     txfiles = []
     for file in args.files:
-        txfile = TxFile(name = file, inifile = CONFIG)
-        txfile.load_config()
+        txfile = registry.load(file)
         txfile.set_rules()
-        txfile.open('a')
+        txfile.open('a', pool)
         txfiles.append(txfile)
 
-    # Find lowest blockheight among txfiles.
-    block_heights = []
-    for txfile in txfiles:
-        block_heights.append(txfile.lastblock)
-    lowest_blockheight = min(block_heights)
-
-    # Starting block for extraction.
-    startblock = lowest_blockheight + 1
-
     # If not lastblock specified -> find latest blockheight available in blockchain database.
     if not args.lastblock:
-        block = Block(2, plyveldb)
-        lastblock = block.find_last_block()
+        lastblock = last_height(plyveldb)
     else:
         lastblock = args.lastblock
 
+    # Files at different heights are caught up group by group, so every block is read once.
+    plans = plan_segments(txfiles, lastblock)
+
     # Extract transactions.
     print("Updating files with new transactions...")
+    stats = start_stats(args)
+    writer = start_writer(stats)
+    checkpointer = Checkpointer(txfiles, registry, writer, blocks = CHECKPOINT_BLOCKS, seconds = CHECKPOINT_INTERVAL,
+                                stats = stats)
+    metrics = start_metrics(txfiles, writer)
+    if metrics:
+        metrics.tip = last_height(plyveldb)
     flag = GracefulExiter()
-    for block in tqdm(range(startblock, lastblock + 1), mininterval = 1, unit = "blocks"):
-        block = Block(block, plyveldb)
-        transactions = block.transactions
+    progress = tqdm(total = sum(len(heights) for _, parts in plans for heights in parts), mininterval = 1,
+                    unit = "blocks")
+    hashes = open_hashes(plyveldb)
+    if not catch_up(plyveldb, plans, checkpointer, flag, writer, progress, stats, metrics, hashes) \
+            and not flag.exit():
+        print("Ending update ...")
+    progress.close()
+
+    # Write queued transactions.
+    if writer:
+        writer.close()
 
-        for transaction in transactions:
-            transaction = Transaction(transaction, plyveldb, blockheight = block.height, blocktimestamp = block.timestamp)
-            
-            # ===Inefficiency here===
-            for txfile in txfiles:
-                if txfile.lastblock != lowest_blockheight:
-                    continue
-                
-                if not transaction.fulfills_criteria(**txfile.rules):
-                    continue
-
-                if not txfile.include_failed_tx:
-                    if not transaction.was_successful():
-                        continue
-                
-                txfile.append_transaction(transaction.get_transaction())
-                txfile.transactions += 1
-        
-        # Update blockheights of txfiles.
-        for txfile in txfiles:
-            if txfile.lastblock == lowest_blockheight:
-                txfile.lastblock +=1
-        
-        # New lowest blockheight among txfiles.
-        lowest_blockheight += 1
+    # Update config and close files.
+    for txfile in txfiles:
+        txfile.close()
+    registry.save(txfiles)
+    plyveldb.close()
+    if hashes:
+        hashes.close()
+    if metrics:
+        metrics.close()
+    report_stats(args, stats)
+
+    if flag.exit():
+        print("Exited gracefully.")
 
-        # Break here if ctrl + c.
-        if flag.exit():
-            break
+
+def follow(args) -> None:
+    """
+    Keep files up to date with the blockchain database.
+    The database is opened every interval seconds, and if it has new blocks they are extracted and the files
+    are checkpointed. The database is only kept open while reading, so whatever writes to it can take the lock in between.
+    """
+    # Prepare list of TxFile objects. They are kept open between polls.
+    pool = FilePool(OUTPUT_OPEN_FILES, OUTPUT_BUFFER_ROWS)
+    txfiles = []
+    for file in args.files:
+        txfile = registry.load(file)
+        txfile.set_rules()
+        txfile.open('a', pool)
+        txfiles.append(txfile)
+
+    print(f"Following the blockchain database every {args.interval} seconds. Stop with ctrl + c.")
+    stats = start_stats(args)
+    writer = start_writer(stats)
+    checkpointer = Checkpointer(txfiles, registry, writer, blocks = CHECKPOINT_BLOCKS, seconds = CHECKPOINT_INTERVAL,
+                                stats = stats)
+    metrics = start_metrics(txfiles, writer)
+    flag = GracefulExiter()
+    while not flag.exit():
+        try:
+            plyveldb = open_db()
+        except OSError as e:
+            # Most likely locked by the process writing to it, try again next poll.
+            print(f"- Could not open the blockchain database: {e}")
+            plyveldb = None
+
+        if plyveldb is not None:
+            tip = last_height(plyveldb)
+            if metrics:
+                metrics.tip = tip
+            height = min(txfile.lastblock for txfile in txfiles)
+            if tip > height:
+                transactions = sum(txfile.transactions for txfile in txfiles)
+                hashes = open_hashes(plyveldb)
+                catch_up(plyveldb, plan_segments(txfiles, tip), checkpointer, flag, writer,
+                         stats = stats, metrics = metrics, hashes = hashes)
+                if hashes:
+                    hashes.close()
+                checkpointer.save()
+                transactions = sum(txfile.transactions for txfile in txfiles) - transactions
+                print(f"- Blocks {height + 1}-{min(txfile.lastblock for txfile in txfiles)}: "
+                      f"{transactions} transactions written.")
+            plyveldb.close()
+
+        # Sleep in short steps to react to ctrl + c.
+        wakeup = time.time() + args.interval
+        while not flag.exit() and time.time() < wakeup:
+            time.sleep(min(0.5, args.interval))
+
+    # Write queued transactions.
+    if writer:
+        writer.close()
 
     # Update config and close files.
     for txfile in txfiles:
-        txfile.lastblock = lowest_blockheight
-        txfile.save_config()
-        txfile.close() 
+        txfile.close()
+    registry.save(txfiles)
+    if metrics:
+        metrics.close()
+    report_stats(args, stats)
+    print("Exited gracefully.")
+
+
+def plan_segments(txfiles: list, lastblock: int) -> list:
+    """
+    Plan bringing txfiles up to lastblock.
+    Return:
+        plans (list) - (Segment, parts of heights to read, see plan_heights) in order.
+    """
+    return [(segment, plan_heights(segment.txfiles, segment.firstblock, segment.lastblock))
+            for segment in schedule(txfiles, lastblock)]
+
+
+def catch_up(plyveldb: Leveldb, plans: list, checkpointer: Checkpointer, flag: GracefulExiter,
+             writer: AsyncWriter = None, progress: tqdm = None, stats: Stats = None, metrics: Metrics = None,
+             hashes: BlockHashes = None) -> bool:
+    """
+    Extract the segments planned by plan_segments, updating lastblock of the files as blocks are processed.
+    Return:
+        complete (bool) - false if interrupted or a block was missing.
+    """
+    for segment, parts in plans:
+        extractor = Extractor(segment.txfiles, plyveldb, receipt_cache_size = RECEIPT_CACHE_SIZE, writer = writer,
+                              stats = stats)
+        if metrics:
+            metrics.receipts = extractor.receipts
+        for n, heights in enumerate(parts):
+            blocks = read_blocks(plyveldb, heights, stats, metrics, hashes, prefilter(segment.txfiles),
+                                 segment.txfiles)
+            processed = 0
+            for block in blocks:
+                extractor.process(block)
+                for txfile in segment.txfiles:
+                    txfile.lastblock = block.height
+                processed += 1
+                if progress is not None:
+                    progress.update()
+                if metrics:
+                    metrics.processed(block.height, len(block.transactions))
+
+                if checkpointer.due():
+                    checkpointer.save()
+
+                # Break here if ctrl + c.
+                if flag.exit():
+                    break
+            blocks.close()
+
+            if flag.exit():
+                return False
+
+            # Blocks skipped by the index are done as well.
+            if processed < len(heights):
+                for txfile in segment.txfiles:
+                    txfile.lastblock = heights[processed] - 1
+                print(f"Block {heights[processed]} not found in database.")
+                return False
+            end = parts[n + 1][0] - 1 if n + 1 < len(parts) else segment.lastblock
+            for txfile in segment.txfiles:
+                txfile.lastblock = end
+    return True
+
+
+def build_hashes(args) -> None:
+    """
+    Build the block hash array, or add the blocks new in the database to it.
+    """
+    if not BLOCK_HASHES or SOURCE == "rpc":
+        print("The block hash array is turned off with an empty block_hashes option and not used with the rpc source.")
+        return
+
+    plyveldb = open_db()
+    print("Reading block hashes...")
+    hashes = open_hashes(plyveldb, create = True)
+    print(f"Block hash array covers blocks up to {hashes.lastheight}.")
+    hashes.close()
+    plyveldb.close()
+
+
+def index(args) -> None:
+    """
+    Build or update the block index.
+    """
+    from tqdm import tqdm
+
+    if os.path.dirname(INDEX):
+        os.makedirs(os.path.dirname(INDEX), exist_ok = True)
+
+    plyveldb = open_db()
+    blockindex = BlockIndex(INDEX)
+    if args.index_command == "build":
+        blockindex.clear()
+
+    # Start where the index ends, or at the first block in the database if it's empty.
+    if blockindex.lastblock:
+        startblock = blockindex.lastblock + 1
+    else:
+        startblock = first_height(plyveldb)
+    if args.lastblock:
+        lastblock = args.lastblock
+    else:
+        lastblock = last_height(plyveldb)
+
+    hashes = open_hashes(plyveldb)
+    print("Indexing blocks...")
+    flag = GracefulExiter()
+    blocks = read_blocks(plyveldb, range(startblock, lastblock + 1), hashes = hashes)
+    batch = []
+    for block in tqdm(blocks, total = max(0, lastblock - startblock + 1), mininterval = 1, unit = "blocks"):
+        batch.append(block)
+        if len(batch) == INDEX_BATCH:
+            blockindex.add_blocks(batch)
+            batch = []
+
+        if flag.exit():
+            break
+    blocks.close()
+    if batch:
+        blockindex.add_blocks(batch)
+
+    print(f"Index covers blocks up to {blockindex.lastblock}.")
+    blockindex.close()
+    if hashes:
+        hashes.close()
     plyveldb.close()
 
     if flag.exit():
@@ -362,25 +769,16 @@ def remove(args) -> None:
     """
     Remove file from output directory and clear configurations for that file itx.ini.
     """
-    config = configparser.ConfigParser()
-    config.read(CONFIG)
-    
     if args.all:
-        txfiles = config.sections()
+        txfiles = registry.names()
 
     else:
         txfiles = args.files
 
     for txfile in txfiles:
-        txfile = TxFile(name = txfile, inifile = CONFIG)
-        txfile.load_config()
+        txfile = registry.load(txfile)
         txfile.delete_file()
-        txfile.delete_config()
-
-def syncronize():
-    ## TODO
-    pass
-
+    registry.save(removed = txfiles)
 
 def status(args) -> None:
     """
@@ -389,16 +787,211 @@ def status(args) -> None:
     if  args.files:
         txfiles = args.files
     else:
-        config = configparser.ConfigParser()
-        config.read(CONFIG)
-        txfiles = config.sections()
+        txfiles = registry.names()
 
     for txfile in txfiles:
-        txfile = TxFile(name = txfile, inifile = CONFIG)
-        txfile.load_config()
+        txfile = registry.load(txfile)
         txfile.print_status()
 
 
+def open_db() -> plyvel.DB:
+    """
+    Open the local blockchain database with the leveldb options from the configuration file.
+    With source = rpc, an RpcSource reading from rpc_url is returned instead.
+    """
+    # Imported here so commands not reading the blockchain start fast.
+    if SOURCE == "rpc":
+        from rpc import ResponseCache
+        from rpc import RpcSource
+        cache = None
+        if RPC_CACHE:
+            if os.path.dirname(RPC_CACHE):
+                os.makedirs(os.path.dirname(RPC_CACHE), exist_ok = True)
+            cache = ResponseCache(RPC_CACHE, RPC_CACHE_SIZE)
+        return RpcSource(RPC_URL, batch_size = RPC_BATCH_SIZE, concurrency = RPC_CONCURRENCY,
+                         retries = RPC_RETRIES, timeout = RPC_TIMEOUT, cache = cache)
+    import plyvel
+    return plyvel.DB(LEVELDB, create_if_missing = False, **LEVELDB_OPTIONS)
+
+
+def read_blocks(db: Leveldb, heights: range, stats: Stats = None, metrics: Metrics = None,
+                hashes: BlockHashes = None, prefilter: Prefilter = None, txfiles: list = ()):
+    """
+    Stream blocks from the database or rpc source, with the prefetch options from the configuration file.
+    The rpc source returns decoded blocks, so prefilter is only used with leveldb. It fetches the transaction
+    results txfiles need along with the blocks instead, see receipts_wanted.
+    """
+    if SOURCE == "rpc":
+        return db.stream_blocks(heights, stats = stats, wanted = receipts_wanted(txfiles))
+    return stream_blocks(db, heights, depth = PREFETCH_DEPTH, workers = PREFETCH_WORKERS,
+                         scan = SCAN and isinstance(heights, range), fill_cache = FILL_CACHE, stats = stats,
+                         monitor = metrics.queues if metrics else None, hashes = hashes, prefilter = prefilter)
+
+
+def prefilter(txfiles: list) -> Prefilter:
+    """
+    Return a Prefilter for the rules of txfiles, None if turned off or the rules can't be prefiltered.
+    """
+    if not PREFILTER:
+        return None
+    return Prefilter.build([txfile.rules for txfile in txfiles])
+
+
+def receipts_wanted(txfiles: list):
+    """
+    Return a function of a transaction dict, true if some file not including failed transactions could match it
+    and its result has to be looked up. None if every file includes failed transactions.
+    """
+    rules = [txfile.rules for txfile in txfiles if not txfile.include_failed_tx]
+    if not rules:
+        return None
+    return RuleIndex(rules).candidates
+
+
+def open_hashes(db: Leveldb, create: bool = False) -> BlockHashes:
+    """
+    Open the block hash array and add the blocks new in the database.
+    It's created by the hashes command, other commands only use it if it exists.
+    Return:
+        hashes (BlockHashes) - None if there is none, or with the rpc source.
+    """
+    if not BLOCK_HASHES or SOURCE == "rpc":
+        return None
+    if not create and not os.path.exists(BLOCK_HASHES):
+        return None
+    if os.path.dirname(BLOCK_HASHES):
+        os.makedirs(os.path.dirname(BLOCK_HASHES), exist_ok = True)
+    hashes = BlockHashes(BLOCK_HASHES)
+    added = hashes.extend(db)
+    if added:
+        print(f"- Added {added} blocks to the block hash array, it covers blocks up to {hashes.lastheight}.")
+    return hashes
+
+
+def read_block(db: Leveldb, height: int) -> Block:
+    """
+    Read one block from the database or rpc source.
+    Raises LookupError if it doesn't have the block.
+    """
+    if SOURCE == "rpc":
+        data = db.get_blocks([height])[0]
+        if data is None:
+            raise LookupError(f"Block {height} not found at {RPC_URL}.")
+        return Block(height, None, data)
+    raw = Block.get_raw_block(height, db, fill_cache = FILL_CACHE)
+    if raw is None:
+        raise LookupError(f"Block {height} not found in database.")
+    return Block(height, db, json.loads(raw))
+
+
+def resolve_times(args, db: Leveldb) -> None:
+    """
+    Set args.firstblock and args.lastblock from args.since and args.until, by binary search over block timestamps.
+    --since resolves to the first block at or after it and --until to the last block before it.
+    """
+    if os.path.dirname(TIMESTAMPS):
+        os.makedirs(os.path.dirname(TIMESTAMPS), exist_ok = True)
+    timestamps = TimestampIndex(TIMESTAMPS)
+    first = first_height(db)
+    tip = last_height(db)
+    read = lambda height: read_block(db, height)
+
+    if args.since is not None:
+        args.firstblock = timestamps.search(args.since, first, tip, read)
+        print(f"- First block at or after {format_time(args.since)} is {args.firstblock}.")
+    if args.until is not None:
+        args.lastblock = timestamps.search(args.until, max(first, args.firstblock), tip, read) - 1
+        print(f"- Last block before {format_time(args.until)} is {args.lastblock}.")
+    timestamps.close()
+
+
+def format_time(timestamp: int) -> str:
+    return datetime.datetime.fromtimestamp(timestamp / 1000000, datetime.timezone.utc).isoformat()
+
+
+def first_height(db: Leveldb) -> int:
+    """
+    Return the height of the first block in the database or rpc source, ignoring the genesisblock.
+    """
+    if SOURCE == "rpc":
+        return db.first_height()
+    return max(1, Block.first_height(db))
+
+
+def last_height(db: Leveldb) -> int:
+    """
+    Return the height of the last block in the database or rpc source.
+    """
+    if SOURCE == "rpc":
+        return db.last_height()
+    return Block.last_height(db)
+
+
+def start_writer(stats: Stats = None) -> AsyncWriter:
+    """
+    Start the background writer, unless disabled with writer_queue_depth = 0.
+    """
+    if not WRITER_QUEUE_DEPTH:
+        return None
+    writer = AsyncWriter(depth = WRITER_QUEUE_DEPTH, fsync_interval = FSYNC_INTERVAL, stats = stats)
+    writer.start()
+    return writer
+
+
+def start_metrics(txfiles: list, writer: AsyncWriter = None) -> Metrics:
+    """
+    Start exposing metrics if metrics_file or metrics_port is set in the configuration file.
+    """
+    if not (METRICS_FILE or METRICS_PORT):
+        return None
+    metrics = Metrics(METRICS_FILE, METRICS_PORT, METRICS_INTERVAL)
+    metrics.txfiles = txfiles
+    metrics.writer = writer
+    metrics.start()
+    return metrics
+
+
+def start_stats(args) -> Stats:
+    """
+    Create a Stats if asked for with --stats or --stats-json, otherwise nothing is timed.
+    """
+    if not (args.stats or args.stats_json):
+        return None
+    return Stats()
+
+
+def report_stats(args, stats: Stats) -> None:
+    """
+    Print and/or save the stats of a run.
+    """
+    if stats is None:
+        return
+    if args.stats:
+        stats.report()
+    if args.stats_json:
+        stats.save(args.stats_json)
+        print(f"Stats written to {args.stats_json}.")
+
+
+def plan_heights(txfiles: list, firstblock: int, lastblock: int) -> list:
+    """
+    Heights to read for extracting to txfiles, in parts read one after the other.
+    Uses the block index for the blocks it covers when it can answer the rules of every file.
+    Return:
+        parts (list) - list of heights from the index followed by a range of the blocks after it,
+                       otherwise only the range firstblock - lastblock.
+    """
+    if os.path.exists(INDEX):
+        blockindex = BlockIndex(INDEX)
+        parts = blockindex.heights([txfile.rules for txfile in txfiles], firstblock, lastblock)
+        indexed = blockindex.lastblock
+        blockindex.close()
+        if parts is not None:
+            print(f"- Using block index up to block {min(indexed, lastblock)}, {len(parts[0])} blocks to read there.")
+            return parts
+    return [range(firstblock, lastblock + 1)]
+
+
 def proceed() -> bool:
     """
     Ask to prooceed with extraction or not
@@ -427,23 +1020,31 @@ class GracefulExiter():
 
 
 class ProgressTracker(Thread):
+    """
+    Prints a progress report every report_interval seconds.
+    The caller counts processed blocks and written transactions in block_counter and transaction_counter.
+    """
 
     def __init__(self, start_block, end_block, report_interval = 60):
-        Thread.__init__(self)
+        Thread.__init__(self, daemon = True)
         self.start_time = time.time()
         self.start_block = start_block
         self.end_block = end_block
         self.block_counter = 0
         self.transaction_counter = 0
-        self.blockheight_last_report = start_block
+        self.blocks_last_report = 0
         self.report_interval = report_interval
+        self.stopped = threading.Event()
 
 
     def run(self):
-        while True:
-            time.sleep(self.report_interval)
+        while not self.stopped.wait(self.report_interval):
             self.report_progress()
-            self.blockheight_last_report = self.block_counter
+            self.blocks_last_report = self.block_counter
+
+
+    def stop(self):
+        self.stopped.set()
 
 
     def report_progress(self):
@@ -451,7 +1052,7 @@ class ProgressTracker(Thread):
         print("---------------")
         print(f"Runtime:                           {self.runtime()}")
         print(f"Speed:                             {self.speed()} b/s")
-        print(f"Blocks:                            {self.block_counter}/{self.end_block}  ")
+        print(f"Blocks:                            {self.block_counter}/{self.end_block - self.start_block + 1}  ")
         print(f"Transactions:                      {self.transaction_counter}  ")
         print(f"Eta:                               {self.eta()}  ")
 
@@ -460,20 +1061,25 @@ class ProgressTracker(Thread):
         print("End report")
         print("---------------")
         print(f"Finnished in:                      {self.runtime()}")
-        print(f"Blocks processed:                  {self.start_block}-{self.start_block + self.block_counter}")
+        print(f"Blocks processed:                  {self.start_block}-{self.start_block + self.block_counter - 1}")
         print(f"Transactions written to file:      {self.transaction_counter}")
 
 
     def runtime(self):
-        return datetime.timedelta(seconds(time.time() - self.start_time))
+        return datetime.timedelta(seconds = round(time.time() - self.start_time))
 
 
     def speed(self):
-        return round((self.block_counter - self.blockheight_last_report) / 60)
+        # Blocks per second since the last report.
+        return round((self.block_counter - self.blocks_last_report) / self.report_interval)
 
 
     def eta(self):
-        return datetime.timedelta(seconds(args.last-block - self.block_counter) / self.speed())
+        speed = self.speed()
+        if not speed:
+            return "unknown"
+        remaining = self.end_block - self.start_block + 1 - self.block_counter
+        return datetime.timedelta(seconds = round(remaining / speed))
 
 
 # Check if file was entered as argument.
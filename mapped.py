@@ -0,0 +1,50 @@
+from __future__ import annotations
+import mmap
+import os
+
+
+class MappedFile:
+    """
+    File mapped into memory that grows in steps of GROWTH bytes.
+    The file is sparse, space that has not been written to takes no disk space.
+    Subclasses create their views of the mapping in map and release them in unmap.
+    """
+    GROWTH = 1 << 23
+
+    def __init__(self, path: str) -> MappedFile:
+        self.path = path
+        self.fileobj = open(path, 'a+b')
+        self.mm = None
+        self.map()
+
+    @property
+    def size(self) -> int:
+        return len(self.mm) if self.mm is not None else 0
+
+    def map(self) -> None:
+        size = os.fstat(self.fileobj.fileno()).st_size
+        if size:
+            self.mm = mmap.mmap(self.fileobj.fileno(), size)
+
+    def unmap(self) -> None:
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def reserve(self, size: int) -> None:
+        """
+        Grow the file to hold at least size bytes.
+        """
+        if size <= self.size:
+            return
+        self.unmap()
+        self.fileobj.truncate((size // self.GROWTH + 1) * self.GROWTH)
+        self.map()
+
+    def flush(self) -> None:
+        if self.mm is not None:
+            self.mm.flush()
+
+    def close(self) -> None:
+        self.unmap()
+        self.fileobj.close()
@@ -0,0 +1,155 @@
+from __future__ import annotations
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import os
+import threading
+import time
+
+
+class Metrics(threading.Thread):
+    """
+    Exposes the progress of a running extraction in the Prometheus text format.
+
+    The metrics are written to a file every interval seconds, for the node exporter's textfile collector,
+    and/or served on http://127.0.0.1:<port>/metrics. Rates are computed over the last interval.
+    The extraction loop reports each processed block with processed, the other values are read
+    from the objects set on the instance when the metrics are rendered.
+    """
+
+    def __init__(self, path: str = None, port: int = None, interval: float = 5) -> Metrics:
+        """
+        Input:
+            path (str)       - file to write the metrics to, None disables.
+            port (int)       - port to serve the metrics on, None disables.
+            interval (float) - seconds between updates of rates and the file.
+        """
+        threading.Thread.__init__(self, daemon = True)
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.server = None
+
+        self.height = 0
+        self.tip = 0
+        self.blocks = 0
+        self.transactions = 0
+        self.blocks_per_second = 0.0
+        self.transactions_per_second = 0.0
+
+        # Set by the extraction as they are created.
+        self.txfiles = []
+        self.receipts = None
+        self.writer = None
+        self.queues = []
+
+    def processed(self, height: int, transactions: int = 0) -> None:
+        """
+        Count a processed block.
+        """
+        self.height = height
+        self.blocks += 1
+        self.transactions += transactions
+
+    def start(self) -> None:
+        # Serve before starting the thread, so a port in use fails the command.
+        if self.port:
+            self.serve()
+        threading.Thread.start(self)
+
+    def run(self) -> None:
+        last = time.time()
+        blocks, transactions = self.blocks, self.transactions
+        while not self.stopped.wait(self.interval):
+            now = time.time()
+            self.blocks_per_second = (self.blocks - blocks) / (now - last)
+            self.transactions_per_second = (self.transactions - transactions) / (now - last)
+            last, blocks, transactions = now, self.blocks, self.transactions
+            if self.path:
+                self.write()
+
+    def serve(self) -> None:
+        """
+        Start serving the metrics over http on a separate thread.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+    def render(self) -> str:
+        """
+        Return the metrics in the Prometheus text format.
+        """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP itx_{name} {help}")
+            lines.append(f"# TYPE itx_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"itx_{name}{labels} {value}")
+
+        metric("height", "gauge", "Last block processed.", [("", self.height)])
+        metric("tip_height", "gauge", "Last block in the blockchain database.", [("", self.tip)])
+        metric("lag_blocks", "gauge", "Blocks left to the last block in the database.",
+               [("", max(0, self.tip - self.height))])
+        metric("blocks_total", "counter", "Blocks processed.", [("", self.blocks)])
+        metric("transactions_total", "counter", "Transactions processed.", [("", self.transactions)])
+        metric("blocks_per_second", "gauge", "Blocks processed per second.",
+               [("", round(self.blocks_per_second, 1))])
+        metric("transactions_per_second", "gauge", "Transactions processed per second.",
+               [("", round(self.transactions_per_second, 1))])
+        metric("file_transactions_total", "counter", "Transactions written to each file.",
+               [(f'{{file="{txfile.name}"}}', txfile.transactions) for txfile in self.txfiles])
+
+        if self.receipts is not None:
+            hits, misses = self.receipts.hits, self.receipts.misses
+            metric("receipt_cache_hits_total", "counter", "Transaction results found in the cache.", [("", hits)])
+            metric("receipt_cache_misses_total", "counter", "Transaction results read from the database.",
+                   [("", misses)])
+            metric("receipt_cache_hit_ratio", "gauge", "Share of transaction results found in the cache.",
+                   [("", round(hits / (hits + misses), 4) if hits + misses else 0)])
+        if self.writer is not None:
+            metric("writer_queue_depth", "gauge", "Batches waiting for the background writer.",
+                   [("", self.writer.queue.qsize())])
+        if self.queues:
+            metric("prefetch_queue_depth", "gauge", "Decoded blocks waiting to be processed.",
+                   [("", sum(q.qsize() for q in self.queues))])
+        return "\n".join(lines) + "\n"
+
+    def write(self) -> None:
+        """
+        Write the metrics to file, replacing it in one step so a reader never sees half a file.
+        """
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, self.path)
+
+    def close(self) -> None:
+        """
+        Stop updating, write the final values and stop serving.
+        """
+        self.stopped.set()
+        self.join()
+        if self.path:
+            self.write()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
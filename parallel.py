@@ -0,0 +1,131 @@
+from __future__ import annotations
+from blockchain import Block
+from blockchain import decode_block
+from collections import deque
+from extractor import Matcher
+from rules import Prefilter
+import multiprocessing
+import signal
+from stats import Stats
+from stats import timer
+
+
+CHUNK_SIZE = 1000
+
+# Matcher and Prefilter of the current worker process. Set by _init_worker.
+_matcher = None
+_prefilter = None
+
+
+def _init_worker(rules: list, timed: bool = False, prefilter: bool = False) -> None:
+    """
+    Initialize a worker process with the rules of all files.
+    Ctrl + c is handled by the parent process only.
+    """
+    global _matcher, _prefilter
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _matcher = Matcher(rules, Stats() if timed else None)
+    _prefilter = Prefilter.build(rules) if prefilter else None
+
+
+def _match_chunk(chunk: list) -> list:
+    """
+    Decode and match a chunk of blocks in a worker process.
+    Input:
+        chunk (list) - (height, raw block) in block order.
+    Return:
+        results (list) - (height, matches) in block order.
+        stats (dict)   - stats of the chunk if timed, otherwise None.
+    """
+    stats = _matcher.stats
+    clock = timer(stats)
+    results = []
+    for height, raw in chunk:
+        clock.start()
+        block = decode_block(height, None, raw, _prefilter, clock)
+        results.append((height, _matcher.match(block)))
+
+    if stats:
+        # Sent back with every chunk, so start over.
+        _matcher.stats = Stats()
+        return results, stats.to_dict()
+    return results, None
+
+
+def _read_chunk(reader: Leveldb, start: int, stop: int, stats: Stats = None, hashes: BlockHashes = None,
+                scan: bool = False, fill_cache: bool = True) -> tuple:
+    """
+    Read undecoded blocks start - stop (exclusive) from the database or a snapshot of it.
+    With scan the block hashes are read with an iterator over the block height keys, unless taken from hashes.
+    Return:
+        chunk (list) - (height, raw block) for the blocks found.
+        complete (bool) - false if the database ended before stop.
+    """
+    chunk = []
+    clock = timer(stats)
+    blockhashes = None
+    if scan and not hashes:
+        clock.start()
+        with reader.iterator(start = Block.height_key(start), stop = Block.height_key(stop),
+                             fill_cache = fill_cache) as iterator:
+            blockhashes = dict(iterator)
+        clock.lap("leveldb_scan")
+    for height in range(start, stop):
+        clock.start()
+        if blockhashes is None:
+            raw = Block.get_raw_block(height, reader, hashes, fill_cache)
+        else:
+            blockhash = blockhashes.get(Block.height_key(height))
+            raw = reader.get(blockhash, fill_cache = fill_cache) if blockhash is not None else None
+        clock.lap("leveldb_read")
+        if raw is None:
+            return chunk, False
+        chunk.append((height, raw))
+    return chunk, True
+
+
+def parallel_matches(db: Leveldb, rules: list, firstblock: int, lastblock: int,
+                     workers: int, chunksize: int = CHUNK_SIZE, stats: Stats = None, hashes: BlockHashes = None,
+                     prefilter: bool = False, scan: bool = False, fill_cache: bool = True):
+    """
+    Match blocks firstblock - lastblock against rules in a pool of worker processes.
+
+    Leveldb only allows one process to open a database, so the blocks are read here and
+    handed to the workers undecoded. The workers decode and match, which is where the time is spent.
+    At most two chunks per worker are in flight at once.
+    With stats the workers time decoding and matching and send their stats back with each chunk.
+    With prefilter the workers don't decode blocks rejected by a Prefilter of the rules.
+    Blocks are read from one snapshot, with the block hashes read by an iterator with scan, see stream_blocks.
+
+    Yield:
+        (height, matches) - in block order. Stops early if a block is missing from the database.
+    """
+    pool = multiprocessing.Pool(workers, initializer = _init_worker, initargs = (rules, stats is not None, prefilter))
+    reader = db.snapshot()
+    pending = deque()
+    nextblock = firstblock
+    complete = True
+
+    try:
+        while True:
+            # Keep the pool busy.
+            while complete and nextblock <= lastblock and len(pending) < workers * 2:
+                stop = min(nextblock + chunksize, lastblock + 1)
+                chunk, complete = _read_chunk(reader, nextblock, stop, stats, hashes, scan, fill_cache)
+                nextblock = stop
+                if chunk:
+                    pending.append(pool.apply_async(_match_chunk, (chunk,)))
+
+            if not pending:
+                break
+
+            results, chunk_stats = pending.popleft().get()
+            if chunk_stats:
+                stats.merge(chunk_stats)
+                stats.count("blocks", len(results))
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        reader.release()
@@ -0,0 +1,65 @@
+from __future__ import annotations
+import configparser
+import fcntl
+from txfile import TxFile
+from txfile import write_config
+
+
+class Registry:
+    """
+    The configuration file, parsed once.
+    Hands out TxFiles sharing the parsed configuration and writes all changes
+    to the file in one atomic write with save.
+    """
+
+    def __init__(self, inifile: str) -> Registry:
+        self.inifile = inifile
+        self.config = configparser.ConfigParser(interpolation = None)
+        self.config.read(inifile)
+
+    def defaults(self) -> dict:
+        """
+        Return the settings in the DEFAULT section.
+        """
+        return dict(self.config['DEFAULT'])
+
+    def names(self) -> list:
+        """
+        Return the names of all tracked files.
+        """
+        return self.config.sections()
+
+    def txfile(self, **kwargs) -> TxFile:
+        """
+        Create a new TxFile sharing the configuration.
+        """
+        return TxFile(inifile = self.inifile, config = self.config, **kwargs)
+
+    def load(self, name: str) -> TxFile:
+        """
+        Return a TxFile with its settings loaded.
+        """
+        txfile = self.txfile(name = name)
+        txfile.load_config()
+        return txfile
+
+    def save(self, txfiles: list = (), removed: list = ()) -> None:
+        """
+        Remove the settings of the files named in removed, update the settings of txfiles and write the configuration file.
+        The file is read again first and only those sections are changed, so files initialized or removed by other
+        commands since it was parsed, e.g. while follow runs, are kept. It's locked from reading until written.
+        """
+        with open(self.inifile + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            config = configparser.ConfigParser(interpolation = None)
+            config.read(self.inifile)
+            for name in removed:
+                config.remove_section(name)
+            for txfile in txfiles:
+                txfile.save_config(write = False, config = config)
+            write_config(self.inifile, config)
+
+            # Continue from what was written.
+            for name in self.config.sections():
+                self.config.remove_section(name)
+            self.config.read(self.inifile)
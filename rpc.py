@@ -1,60 +1,339 @@
-import requests
+from __future__ import annotations
+from blockchain import Block
+from blockchain import Transaction
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import json
+import os
+import requests
+import sqlite3
+from stats import timer
+import threading
+import time
+import zlib
 
 
 HEADERS = {'content-type': 'application/json'}
-URL = "https://ctz.solidwallet.io/api/v3" 
+URL = "https://ctz.solidwallet.io/api/v3"
 #URL = "http://95.179.230.6:9000/api/v3"
 #URL = "http://127.0.0.1:9000/api/v3"
 
-def get_block(blocknr):
-    blocknr = hex(blocknr)
-    payload = {
-                "jsonrpc": '2.0',
-                "id": '12',
-                "method": "icx_getBlockByHeight",
-                "params": {"height": blocknr}
-              }
-    response = requests.post(URL, data=json.dumps(payload), headers=HEADERS)
-    response = response.json()
-    return response
-
-
-def get_transaction_result(txhash):
-    payload = {
-                "jsonrpc": "2.0",
-                "method": "icx_getTransactionResult",
-                "id": 1234,
-                "params": {"txHash": txhash}
- 	          }
-    response = requests.post(URL, data=json.dumps(payload), headers=HEADERS)
-    response = response.json()
-    return response
-
-
-def get_last_block():
-    payload = {
-                "jsonrpc": "2.0",
-                "method": "icx_getLastBlock",
-                "id": 1232
-              }
-    response = requests.post(URL, data=json.dumps(payload), headers=HEADERS)
-    response = response.json()
-    return response
-
-def transaction_success(txhash):
-    payload = {
-                "jsonrpc": "2.0",
-                "method": "icx_getTransactionResult",
-                "id": 1234,
-                "params": {"txHash": txhash}
- 	          }
-    
-    response = requests.post(URL, data=json.dumps(payload), headers=HEADERS)
-    response = response.json()
-    txstatus = response['result']['status']
-
-    if txstatus:
-        return True
-    else:
-        return False
+# Responses worth retrying.
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+CACHE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql", "rpc_cache.sql")
+
+
+class RpcSource:
+    """
+    Reads blocks and transaction results from a node's JSON-RPC api instead of a local database.
+
+    Heights and txhashes are requested in JSON-RPC batches of batch_size calls, with up to concurrency
+    batches in flight over a pool of keep-alive connections. Failed requests are retried with exponential backoff.
+    Used in place of the leveldb database by extract, update, follow and index, see stream_blocks.
+    """
+
+    def __init__(self, url: str = URL, batch_size: int = 100, concurrency: int = 8,
+                 retries: int = 5, backoff: float = 0.5, timeout: float = 30,
+                 cache: ResponseCache = None) -> RpcSource:
+        """
+        Input:
+            url (str)         - JSON-RPC endpoint, e.g. https://ctz.solidwallet.io/api/v3.
+            batch_size (int)  - calls per request.
+            concurrency (int) - requests in flight at once.
+            retries (int)     - times a failed request is retried.
+            backoff (float)   - seconds before the first retry, doubled for each retry.
+            timeout (float)   - seconds to wait for a response.
+            cache (ResponseCache) - blocks and results are read from and added to it if given.
+        """
+        self.url = url
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+
+        # txhash -> transaction result fetched along with the blocks by stream_blocks, until the blocks are consumed.
+        self.prefetched = {}
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(self.concurrency)
+
+    def call(self, payload: list) -> list:
+        """
+        Post a JSON-RPC batch, retrying on connection errors, timeouts and server errors.
+        Return:
+            responses (list) - in the order of payload.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.url, data = json.dumps(payload), headers = HEADERS,
+                                             timeout = self.timeout)
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    responses = response.json()
+                    if isinstance(responses, dict):
+                        # The whole batch was rejected.
+                        raise RuntimeError(f"JSON-RPC error from {self.url}: {responses.get('error')}")
+                    responses = {item["id"]: item for item in responses}
+                    return [responses[request["id"]] for request in payload]
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            if attempt == self.retries:
+                response.raise_for_status()
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def batch(self, method: str, params: list) -> list:
+        """
+        Call method once for each params in one request.
+        """
+        payload = [{"jsonrpc": "2.0", "id": i, "method": method} for i in range(len(params))]
+        for request, p in zip(payload, params):
+            if p is not None:
+                request["params"] = p
+        return self.call(payload)
+
+    def get_blocks(self, heights: list) -> list:
+        """
+        Return:
+            blocks (list) - block data for each height, None for heights the node doesn't have.
+        """
+        keys = [f"block:{height}" for height in heights]
+        cached = self.cache.get(keys) if self.cache else {}
+        missing = [height for height, key in zip(heights, keys) if key not in cached]
+        if missing:
+            responses = self.batch("icx_getBlockByHeight", [{"height": hex(height)} for height in missing])
+            found = {f"block:{height}": response["result"] for height, response in zip(missing, responses)
+                     if "error" not in response}
+            if self.cache:
+                self.cache.put(found)
+            cached.update(found)
+        return [normalize_block(height, cached[key]) if key in cached else None
+                for height, key in zip(heights, keys)]
+
+    def get_results(self, txhashes: list) -> list:
+        """
+        Fetch transaction results, batch_size per request and concurrency requests at once.
+        Return:
+            txresults (list) - {"result": transaction result} for each txhash, as stored in the database.
+        """
+        chunks = [txhashes[i:i + self.batch_size] for i in range(0, len(txhashes), self.batch_size)]
+        txresults = []
+        for responses in self.executor.map(self.get_results_chunk, chunks):
+            txresults.extend(responses)
+        return txresults
+
+    def get_results_chunk(self, txhashes: list) -> list:
+        prefetched = self.prefetched
+        cached = {txhash: prefetched[txhash] for txhash in txhashes if txhash in prefetched}
+        missing = [txhash for txhash in txhashes if txhash not in cached]
+        if missing and self.cache:
+            cached.update(self.cache.get(missing))
+            missing = [txhash for txhash in missing if txhash not in cached]
+        if missing:
+            responses = self.batch("icx_getTransactionResult", [{"txHash": txhash} for txhash in missing])
+            found = {}
+            for txhash, response in zip(missing, responses):
+                if "error" in response:
+                    raise LookupError(f"No transaction result for {txhash}: {response['error']}")
+                found[txhash] = response["result"]
+            if self.cache:
+                self.cache.put(found)
+            cached.update(found)
+        return [{"result": cached[txhash]} for txhash in txhashes]
+
+    def last_height(self) -> int:
+        """
+        Return the height of the last block of the node.
+        """
+        return self.batch("icx_getLastBlock", [None])[0]["result"]["height"]
+
+    def first_height(self) -> int:
+        """
+        Return the height of the first block of the node, ignoring the genesisblock.
+        Nodes normally have every block, otherwise it's found by binary search up to the last block.
+        """
+        lo, hi = 1, self.last_height()
+        if self.get_blocks([lo])[0] is not None:
+            return lo
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_blocks([mid])[0] is None:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get_batch(self, heights: list, wanted = None) -> tuple:
+        """
+        Fetch the blocks of heights and the transaction results of the transactions in them that wanted selects.
+        The results are kept in prefetched, so get_results doesn't have to wait for them.
+        Input:
+            wanted - function of a transaction dict, true for the transactions whose result is needed.
+        Return:
+            blocks (list)   - Block for each height, None for heights the node doesn't have.
+            txhashes (list) - txhashes of the results added to prefetched.
+        """
+        blocks = [Block(height, None, data) if data is not None else None
+                  for height, data in zip(heights, self.get_blocks(heights))]
+        txhashes = []
+        if wanted:
+            for block in blocks:
+                if block is None:
+                    break
+                txhashes += [Transaction(transaction, None).txhash for transaction in block.transactions
+                             if wanted(transaction)]
+        for i in range(0, len(txhashes), self.batch_size):
+            chunk = txhashes[i:i + self.batch_size]
+            results = self.get_results_chunk(chunk)
+            self.prefetched.update((txhash, result["result"]) for txhash, result in zip(chunk, results))
+        return blocks, txhashes
+
+    def stream_blocks(self, heights: range, stats: Stats = None, wanted = None):
+        """
+        Fetch blocks ahead of the consumer, concurrency batches at a time, and yield them in order.
+        The results of the transactions wanted selects are fetched in the same batches, see get_batch.
+        They're dropped once the blocks of the batch are consumed.
+        Yield:
+            block (Block) - stops at the first block the node doesn't have.
+        """
+        batches = (heights[i:i + self.batch_size] for i in range(0, len(heights), self.batch_size))
+        pending = deque()
+        clock = timer(stats)
+        try:
+            while True:
+                for batch in batches:
+                    pending.append(self.executor.submit(self.get_batch, batch, wanted))
+                    if len(pending) >= self.concurrency:
+                        break
+                if not pending:
+                    return
+
+                future = pending.popleft()
+                clock.start()
+                blocks, txhashes = future.result()
+                clock.lap("rpc_wait")
+                for block in blocks:
+                    if block is None:
+                        return
+                    yield block
+                for txhash in txhashes:
+                    self.prefetched.pop(txhash, None)
+        finally:
+            for future in pending:
+                future.cancel()
+            self.prefetched.clear()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait = True)
+        self.session.close()
+        if self.cache:
+            self.cache.close()
+
+
+class ResponseCache:
+    """
+    On-disk cache of JSON-RPC responses in a sqlite database, so blocks and transaction results
+    fetched once are not fetched again by later runs. Values are stored zlib compressed.
+    When the stored data grows past max_bytes, the least recently used entries are evicted down to 90 % of it.
+    Shared by the threads of an RpcSource.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 0) -> ResponseCache:
+        """
+        Input:
+            path (str)      - sqlite database file.
+            max_bytes (int) - maximum size of the compressed values, 0 for no limit.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with open(CACHE_SCHEMA, 'r') as schema:
+            self.connection.executescript(schema.read())
+
+        self.size, self.used = self.connection.execute(
+            "SELECT IFNULL(SUM(size), 0), IFNULL(MAX(used), 0) FROM responses").fetchone()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, keys: list) -> dict:
+        """
+        Return:
+            responses (dict) - key -> decoded response for the keys in the cache.
+        """
+        with self.lock:
+            self.used += 1
+            rows = []
+            # Stay below sqlite's limit on query parameters.
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows += self.connection.execute(
+                    f"SELECT key, data FROM responses WHERE key IN ({', '.join('?' * len(chunk))})", chunk).fetchall()
+            if rows:
+                with self.connection:
+                    self.connection.executemany("UPDATE responses SET used = ? WHERE key = ?",
+                                                [(self.used, key) for key, _ in rows])
+            self.hits += len(rows)
+            self.misses += len(keys) - len(rows)
+        return {key: json.loads(zlib.decompress(data)) for key, data in rows}
+
+    def put(self, responses: dict) -> None:
+        """
+        Add responses, key -> decoded response, and evict if the cache is full.
+        """
+        if not responses:
+            return
+        rows = []
+        for key, response in responses.items():
+            data = zlib.compress(json.dumps(response, separators = (",", ":")).encode())
+            rows.append((key, data, len(data)))
+
+        with self.lock:
+            self.used += 1
+            with self.connection:
+                for key, data, size in rows:
+                    old = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                    if old:
+                        self.size -= old[0]
+                    self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                                            (key, data, size, self.used))
+                    self.size += size
+            if self.max_bytes and self.size > self.max_bytes:
+                self.evict(int(self.max_bytes * 0.9))
+
+    def evict(self, target: int) -> None:
+        """
+        Remove the least recently used entries until the size is at most target. Called with the lock held.
+        """
+        keys = []
+        size = self.size
+        for key, entry_size in self.connection.execute("SELECT key, size FROM responses ORDER BY used"):
+            if size <= target:
+                break
+            keys.append((key,))
+            size -= entry_size
+        with self.connection:
+            self.connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self.size = size
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def normalize_block(height: int, data: dict) -> dict:
+    """
+    The api returns every block in the v1 format, with confirmed_transaction_list and an integer time_stamp.
+    Block expects the v3 format from the v3 block height, so those blocks are converted.
+    """
+    if height >= Block.V3_BLOCK_HEIGHT and "transactions" not in data:
+        data["transactions"] = data["confirmed_transaction_list"]
+        data["timestamp"] = hex(data["time_stamp"])
+    return data
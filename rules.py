@@ -0,0 +1,474 @@
+from __future__ import annotations
+from blockchain import VERSIONS
+from blockchain import transaction_class
+import decimal
+import functools
+import operator
+import re
+
+
+# Multiplier of the icx unit in where expressions. Values are in loop, 1 icx = 10^18 loop.
+ICX = 10 ** 18
+
+# Names usable in where expressions -> transaction attribute. Parameters are reached with params.<path>.
+WHERE_FIELDS = {"from": "from_", "to": "to", "value": "value", "datatype": "datatype", "method": "method",
+                "txhash": "txhash", "block": "blockheight", "blocktimestamp": "blocktimestamp"}
+
+COMPARISONS = {"==": operator.eq, "=": operator.eq, "!=": operator.ne,
+               "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+TOKENS = re.compile(r"""\s*(?:("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|(-?0x[0-9a-fA-F]+|-?\d+(?:\.\d+)?)"""
+                    r"""|(==|!=|<=|>=|<|>|=|\(|\)|\[|\]|,)|([A-Za-z_][\w.*]*))""")
+
+
+# Characters that never need escaping in json, so a literal is stored in a block as is.
+PLAIN = re.compile(r"[A-Za-z0-9_.:-]*")
+
+
+class RuleError(ValueError):
+    """
+    Raised for a where expression that can't be compiled.
+    """
+
+
+class RuleIndex:
+    """
+    Dispatch index over the rules of many files.
+    Each file is registered under the values of one of its filters, so a transaction
+    only has to be tested against the files that share its to, from, method or datatype.
+    Files without any indexable filter are kept in a wildcard bucket that is always tested.
+    """
+    # Rule name -> transaction attribute. In order of preference when picking
+    # which filter a file is indexed by.
+    FIELDS = {"methods": "method", "from_": "from_", "to": "to", "datatypes": "datatype"}
+
+    def __init__(self, rules: list) -> RuleIndex:
+        """
+        Input:
+            rules (list) - rules for each file, as set by TxFile.set_rules.
+        """
+        self.rules = rules
+        self.predicates = [compile_rules(file_rules) for file_rules in rules]
+        self.index = {field: {} for field in self.FIELDS}
+        self.wildcard = []
+
+        for i, file_rules in enumerate(rules):
+            for field in self.FIELDS:
+                values = file_rules.get(field)
+                if values:
+                    for value in values:
+                        self.index[field].setdefault(value, []).append(i)
+                    break
+            else:
+                self.wildcard.append(i)
+
+        # Only look up fields some file is indexed by, read with the getters of each transaction version.
+        self.lookups = {version: [(cls.getter(self.FIELDS[field]), index) for field, index in self.index.items() if index]
+                        for version, cls in VERSIONS.items()}
+
+    def candidates(self, transaction: dict) -> list:
+        """
+        Return indices of the files whose rules the transaction could fulfill.
+        Input:
+            transaction (dict) - transaction as in the block, so no Transaction is created for
+                                 the transactions without candidates.
+        """
+        lookups = self.lookups.get(transaction.get('version', "0x1"))
+        if lookups is None:
+            transaction_class(transaction)
+        candidates = list(self.wildcard)
+        for get, index in lookups:
+            files = index.get(get(transaction))
+            if files:
+                candidates.extend(files)
+        return candidates
+
+    def match(self, transaction: Transaction, candidates: list = None) -> list:
+        """
+        Return indices of the files whose rules the transaction fulfills.
+        Input:
+            candidates (list) - from candidates, looked up if not given.
+        """
+        if candidates is None:
+            candidates = self.candidates(transaction.raw_transaction)
+        predicates = self.predicates
+        return [i for i in candidates if predicates[i](transaction)]
+
+
+class Prefilter:
+    """
+    Byte level test of undecoded blocks, run before json decoding to skip blocks that can't hold
+    a transaction matching any file.
+    Each file is represented by the values of one of its filters, since a matching transaction must have one of them.
+    The values are looked up among the values of the corresponding key in the raw block, e.g. "to": "cx...",
+    with one regular expression scan per key however many values there are.
+    A block passing the test is decoded and matched as usual, so it only has to let through every block that can match.
+    """
+    # Rule name -> key in the block data. In order of preference, as RuleIndex.FIELDS.
+    KEYS = {"methods": "method", "from_": "from", "to": "to", "datatypes": "dataType"}
+
+    def __init__(self, values: dict) -> Prefilter:
+        """
+        Input:
+            values (dict) - block key -> values, a block passes if one of them is found for the key.
+        """
+        self.tests = []
+        for key, literals in values.items():
+            pattern = re.compile(rb'"' + key.encode() + rb'":\s*"([^"\\]*)"')
+            self.tests.append((pattern.findall, frozenset(literal.encode() for literal in literals)))
+
+    @classmethod
+    def build(cls, rules: list) -> Prefilter:
+        """
+        Input:
+            rules (list) - rules for each file, as set by TxFile.set_rules.
+        Return:
+            prefilter (Prefilter) - None if some file has no filter with values that can be searched for,
+                                    then every block can match.
+        """
+        values = {}
+        for file_rules in rules:
+            for name, key in cls.KEYS.items():
+                literals = file_rules.get(name)
+                if literals and all(PLAIN.fullmatch(literal) for literal in literals):
+                    values.setdefault(key, set()).update(literals)
+                    break
+            else:
+                return None
+        return cls(values)
+
+    def match(self, raw: bytes) -> bool:
+        """
+        Test if the undecoded block can hold a matching transaction.
+        """
+        for findall, literals in self.tests:
+            if not literals.isdisjoint(findall(raw)):
+                return True
+        return False
+
+
+def compile_rules(rules: dict):
+    """
+    Compile the rules of a file into one predicate, testing the same as Transaction.fulfills_criteria
+    and every where expression of the rules. Only the filters that are set are tested.
+    Input:
+        rules (dict) - rules of a file, as set by TxFile.set_rules.
+    Return:
+        predicate - function of a Transaction returning true if it fulfills the rules.
+    """
+    checks = []
+    for name, attribute in (("from_", "from_"), ("to", "to"), ("datatypes", "datatype"), ("methods", "method")):
+        values = rules.get(name)
+        if values:
+            checks.append(member(operator.attrgetter(attribute), frozenset(values)))
+
+    params = rules.get("params")
+    if params:
+        params = frozenset(params)
+        checks.append(lambda transaction: isinstance(transaction.params, dict)
+                                          and not params.isdisjoint(transaction.params))
+
+    for expression in rules.get("where") or ():
+        checks.append(compile_where(expression))
+
+    if not checks:
+        return lambda transaction: True
+    return all_of(checks)
+
+
+def compile_where(expression: str):
+    """
+    Compile a where expression into a predicate of a Transaction.
+
+    Comparisons are written <field> <op> <literal>, with op one of == != < <= > >=, or <field> in [<literal>, ...].
+    A field is one of WHERE_FIELDS, params.<path> or sum(params.<path>). Path elements are dictionary keys or
+    list positions, * matches every element and the comparison holds if it holds for any of them.
+    Numbers are compared as numbers, fields with hex strings like value are converted, and icx after a number
+    multiplies it by 10^18. Strings are compared as strings and may be written unquoted.
+    exists <field> tests if a field is set. A missing field, or a list or dictionary, fails every comparison.
+    Comparisons are combined with not, and, or and parentheses.
+    Example: method == setDelegation and sum(params.delegations.*.value) > 10000 icx
+    Raise:
+        RuleError - if the expression can't be parsed.
+    """
+    return WhereParser(expression).parse()
+
+
+class WhereParser:
+    """
+    Recursive descent parser for where expressions, building the predicate while parsing.
+    """
+
+    def __init__(self, expression: str) -> WhereParser:
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def error(self, message: str) -> RuleError:
+        return RuleError(f"{message} in where expression: {self.expression}")
+
+    def peek(self) -> tuple:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def next(self) -> tuple:
+        token = self.peek()
+        if token[0] is None:
+            raise self.error("Unexpected end")
+        self.position += 1
+        return token
+
+    def keyword(self, *words: str) -> bool:
+        """
+        Consume the next token if it's one of words, case insensitive.
+        """
+        kind, text = self.peek()
+        if kind == "word" and text.lower() in words:
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, text: str) -> None:
+        if self.next() != ("op", text):
+            raise self.error(f"Expected {text}")
+
+    def parse(self):
+        predicate = self.parse_or()
+        if self.peek()[0] is not None:
+            raise self.error(f"Unexpected {self.peek()[1]}")
+        return predicate
+
+    def parse_or(self):
+        predicates = [self.parse_and()]
+        while self.keyword("or"):
+            predicates.append(self.parse_and())
+        return any_of(predicates)
+
+    def parse_and(self):
+        predicates = [self.parse_not()]
+        while self.keyword("and"):
+            predicates.append(self.parse_not())
+        return all_of(predicates)
+
+    def parse_not(self):
+        if self.keyword("not"):
+            predicate = self.parse_not()
+            return lambda transaction: not predicate(transaction)
+        if self.peek() == ("op", "("):
+            self.next()
+            predicate = self.parse_or()
+            self.expect(")")
+            return predicate
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        if self.keyword("exists"):
+            get, many = self.parse_field()
+            if many:
+                return lambda transaction: bool(get(transaction))
+            return lambda transaction: get(transaction) is not None
+
+        get, many = self.parse_field()
+        if self.keyword("in"):
+            self.expect("[")
+            literals = [self.parse_literal()]
+            while self.peek() == ("op", ","):
+                self.next()
+                literals.append(self.parse_literal())
+            self.expect("]")
+            test = in_test(literals)
+        else:
+            kind, op = self.next()
+            if kind != "op" or op not in COMPARISONS:
+                raise self.error(f"Expected comparison, got {op}")
+            test = comparison_test(op, self.parse_literal(), self.error)
+
+        if many:
+            return lambda transaction: any(test(value) for value in get(transaction))
+        return lambda transaction: test(get(transaction))
+
+    def parse_field(self) -> tuple:
+        """
+        Return:
+            get        - function of a Transaction returning the field.
+            many (bool) - true if get returns a list of values.
+        """
+        kind, name = self.next()
+        if kind != "word":
+            raise self.error(f"Expected field, got {name}")
+        if name.lower() == "sum" and self.peek() == ("op", "("):
+            self.next()
+            get, many = self.parse_field()
+            self.expect(")")
+            if not many:
+                raise self.error("sum needs a path with *")
+            return (lambda transaction: sum(n for n in map(number, get(transaction)) if n is not None)), False
+
+        if name in WHERE_FIELDS:
+            return operator.attrgetter(WHERE_FIELDS[name]), False
+        keys = name.split(".")
+        if keys[0] != "params" or len(keys) < 2 or "" in keys:
+            raise self.error(f"Unknown field {name}")
+        keys = keys[1:]
+        if "*" in keys:
+            return path_values(keys), True
+        return path_value(keys), False
+
+    def parse_literal(self):
+        kind, text = self.next()
+        if kind == "string":
+            return re.sub(r"\\(.)", r"\1", text[1:-1])
+        if kind == "number":
+            if text.lstrip("-").startswith("0x"):
+                value = int(text, 16)
+            else:
+                value = decimal.Decimal(text)
+            if self.keyword("icx"):
+                value = value * ICX
+            if isinstance(value, decimal.Decimal) and value == value.to_integral_value():
+                value = int(value)
+            return value
+        if kind == "word":
+            return text
+        raise self.error(f"Expected value, got {text}")
+
+
+def tokenize(expression: str) -> list:
+    """
+    Return:
+        tokens (list) - (kind, text) with kind one of string, number, op and word.
+    """
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKENS.match(expression, position)
+        if not match:
+            raise RuleError(f"Invalid character at {position + 1} in where expression: {expression}")
+        for kind, text in zip(("string", "number", "op", "word"), match.groups()):
+            if text is not None:
+                tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+def number(value):
+    """
+    Return value as an int or a Decimal, hex strings converted, or None if it isn't a finite number.
+    Params are user input, so NaN and infinity are not numbers here.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        try:
+            if value.lstrip("-")[:2] == "0x":
+                return int(value, 16)
+            value = decimal.Decimal(value)
+        except (ValueError, decimal.InvalidOperation):
+            return None
+    elif isinstance(value, float):
+        value = decimal.Decimal(str(value))
+    elif not isinstance(value, decimal.Decimal):
+        return None
+    return value if value.is_finite() else None
+
+
+def comparison_test(op: str, literal, error):
+    """
+    Return a function testing a field value against literal.
+    """
+    compare = COMPARISONS[op]
+    if isinstance(literal, str):
+        if compare is operator.eq:
+            return lambda value: value == literal
+        if compare is operator.ne:
+            return lambda value: isinstance(value, str) and value != literal
+        raise error(f"Can't compare with {op} to text {literal}")
+    return lambda value: compare_number(compare, value, literal)
+
+
+def compare_number(compare, value, literal) -> bool:
+    value = number(value)
+    return value is not None and compare(value, literal)
+
+
+def in_test(literals: list):
+    """
+    Return a function testing if a field value is one of literals.
+    """
+    strings = frozenset(literal for literal in literals if isinstance(literal, str))
+    numbers = frozenset(literal for literal in literals if not isinstance(literal, str))
+    if not numbers:
+        return lambda value: isinstance(value, str) and value in strings
+    return lambda value: (isinstance(value, str) and value in strings) or number(value) in numbers
+
+
+def path_value(keys: list):
+    """
+    Return a function getting the parameter at the path keys, None if it's missing.
+    """
+    def get(transaction):
+        value = transaction.params
+        for key in keys:
+            value = child(value, key)
+            if value is None:
+                return None
+        return value
+    return get
+
+
+def path_values(keys: list):
+    """
+    Return a function getting the list of parameters at the path keys, where * matches every element.
+    """
+    def get(transaction):
+        values = [transaction.params]
+        for key in keys:
+            found = []
+            for value in values:
+                if key == "*":
+                    if isinstance(value, dict):
+                        found.extend(value.values())
+                    elif isinstance(value, list):
+                        found.extend(value)
+                    continue
+                value = child(value, key)
+                if value is not None:
+                    found.append(value)
+            values = found
+        return values
+    return get
+
+
+def child(value, key: str):
+    """
+    Return the element key of a dict, or position key of a list, None if missing.
+    Other values, e.g. strings, have no elements.
+    """
+    if isinstance(value, dict):
+        return value.get(key)
+    if isinstance(value, list) and key.isdigit():
+        position = int(key)
+        return value[position] if position < len(value) else None
+    return None
+
+
+def member(get, values: frozenset):
+    return lambda transaction: get(transaction) in values
+
+
+def all_of(predicates: list):
+    """
+    Combine predicates with and, without a loop for the common case of one or two.
+    """
+    return functools.reduce(lambda a, b: lambda transaction: a(transaction) and b(transaction), predicates)
+
+
+def any_of(predicates: list):
+    """
+    Combine predicates with or.
+    """
+    return functools.reduce(lambda a, b: lambda transaction: a(transaction) or b(transaction), predicates)
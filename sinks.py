@@ -0,0 +1,329 @@
+from __future__ import annotations
+import csv
+from decimal import Decimal
+import json
+import os
+import sqlite3
+
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql", "schema.sql")
+WRITE_BUFFER = 1024 * 1024
+
+
+class CsvSink:
+    """
+    Writes transactions as rows in a csv file.
+    """
+
+    def __init__(self, path: str, mode: str, columns: list) -> CsvSink:
+        self.columns = columns
+        self.fileobj = open(path, mode, buffering = WRITE_BUFFER)
+        self.csvwriter = csv.writer(self.fileobj)
+
+    def write_header(self) -> None:
+        self.csvwriter.writerow(self.columns)
+
+    def write(self, tx: dict) -> None:
+        self.csvwriter.writerow([tx[column] for column in self.columns])
+
+    def sync(self) -> None:
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+
+    def position(self) -> int:
+        """
+        Return the byte offset written up to.
+        """
+        self.fileobj.flush()
+        return self.fileobj.tell()
+
+    def rollback(self, position: int) -> None:
+        """
+        Remove everything written after position.
+        """
+        self.fileobj.flush()
+        if os.fstat(self.fileobj.fileno()).st_size > position:
+            self.fileobj.truncate(position)
+            self.fileobj.seek(position)
+
+    def close(self) -> None:
+        self.fileobj.close()
+
+
+class SqliteSink:
+    """
+    Writes transactions to a table in a sqlite database.
+    Rows are inserted in batches, each batch in one database transaction.
+    txhash is the primary key and duplicates are ignored, so extracting the same blocks twice is harmless.
+    Rows breaking other constraints of the table raise sqlite3.IntegrityError.
+
+    The tables in sql/schema.sql are created in every database. If the table does not exist
+    it is created with the columns of the file.
+    """
+    # Table column -> transaction feature, where they differ.
+    ALIASES = {"timestamp": "blocktimestamp"}
+
+    def __init__(self, path: str, table: str, columns: list, batch_size: int = 1000) -> SqliteSink:
+        self.table = table
+        self.batch_size = batch_size
+        self.rows = []
+
+        # The connection may be handed to the writer thread, it's only used by one thread at a time.
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with open(SCHEMA, 'r') as schema:
+            self.connection.executescript(schema.read())
+
+        if not self.table_columns():
+            columns = list(columns)
+            if "txhash" not in columns:
+                columns.append("txhash")
+            definitions = [f'"{column}" TEXT PRIMARY KEY' if column == "txhash" else f'"{column}"'
+                           for column in columns]
+            with self.connection:
+                self.connection.execute(f'CREATE TABLE "{table}" ({", ".join(definitions)})')
+
+        self.columns = self.table_columns()
+        names = ", ".join(f'"{column}"' for column in self.columns)
+        values = ", ".join("?" * len(self.columns))
+        self.insert = f'INSERT INTO "{table}" ({names}) VALUES ({values})'
+        # Only duplicates are ignored, OR IGNORE would also drop rows breaking other constraints, e.g. NOT NULL.
+        if self.unique_txhash():
+            self.insert += ' ON CONFLICT("txhash") DO NOTHING'
+
+    def table_columns(self) -> list:
+        """
+        Return the column names of the table, empty if it does not exist.
+        """
+        return [row[1] for row in self.connection.execute(f'PRAGMA table_info("{self.table}")')]
+
+    def unique_txhash(self) -> bool:
+        """
+        Test if txhash is the primary key of the table or has a unique index.
+        """
+        for index in self.connection.execute(f'PRAGMA index_list("{self.table}")').fetchall():
+            if index[2]:
+                columns = [row[2] for row in self.connection.execute(f'PRAGMA index_info("{index[1]}")')]
+                if columns == ["txhash"]:
+                    return True
+        return False
+
+    def write_header(self) -> None:
+        pass
+
+    def write(self, tx: dict) -> None:
+        row = []
+        for column in self.columns:
+            value = tx.get(self.ALIASES.get(column, column))
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value)
+            row.append(value)
+        self.rows.append(row)
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Insert buffered rows.
+        """
+        if not self.rows:
+            return
+        with self.connection:
+            self.connection.executemany(self.insert, self.rows)
+        self.rows = []
+
+    def sync(self) -> None:
+        self.flush()
+
+    def position(self) -> int:
+        """
+        Return the last rowid inserted. Rows are never updated, so later rows have higher rowids.
+        """
+        self.flush()
+        return self.connection.execute(f'SELECT IFNULL(MAX(rowid), 0) FROM "{self.table}"').fetchone()[0]
+
+    def rollback(self, position: int) -> None:
+        """
+        Remove rows inserted after position.
+        """
+        with self.connection:
+            self.connection.execute(f'DELETE FROM "{self.table}" WHERE rowid > ?', (position,))
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+
+class ParquetSink:
+    """
+    Writes transactions to a directory of parquet files, with typed columns.
+    Every time the sink is opened or its position is taken a new part file is started,
+    so data written before a checkpoint is never rewritten by the sink. Part numbers only increase.
+    Rows are buffered and written as row groups of row_group_size rows.
+    Checkpoints leave small part files behind, which are merged by compact once they add up to a row group.
+    Requires pyarrow.
+    """
+
+    def __init__(self, path: str, columns: list, row_group_size: int = 100000) -> ParquetSink:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow. Install it with: pip install pyarrow")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+
+        types = {"block": pyarrow.int64(), "blocktimestamp": pyarrow.timestamp("us"),
+                 "value": pyarrow.decimal128(38, 0)}
+        self.columns = columns
+        self.schema = pyarrow.schema([(column, types.get(column, pyarrow.string())) for column in columns])
+        self.row_group_size = row_group_size
+        self.buffer = {column: [] for column in columns}
+        self.rows = 0
+
+        # Next free part file.
+        self.folder = path
+        os.makedirs(path, exist_ok = True)
+        self.recover(path)
+        self.part = max(self.parts(), default = -1) + 1
+        self.writer = None
+
+    @property
+    def path(self) -> str:
+        return self.part_path(self.folder, self.part)
+
+    @staticmethod
+    def part_path(folder: str, part: int) -> str:
+        return os.path.join(folder, f"part-{part:05d}.parquet")
+
+    @staticmethod
+    def list_parts(folder: str) -> list:
+        """
+        Return the numbers of the existing part files in folder.
+        """
+        return [int(name[5:-8]) for name in os.listdir(folder)
+                if name.startswith("part-") and name.endswith(".parquet")]
+
+    def parts(self) -> list:
+        return self.list_parts(self.folder)
+
+    @classmethod
+    def compact(cls, folder: str, row_group_size: int) -> None:
+        """
+        Merge the part files at the end of folder holding less than row_group_size rows each into one file,
+        once they hold row_group_size rows together, so checkpoints don't leave a directory of tiny files and row groups.
+        The merged file is a full row group or more and is never merged again, so every row is rewritten at most once.
+        Only call when no part is being written and every part file is part of a saved checkpoint.
+
+        The merged file is written next to the parts under a temporary name recording the parts it replaces.
+        Once it's complete the parts are replaced by it, and recover finishes that step if it was interrupted.
+        """
+        import pyarrow
+        import pyarrow.parquet
+        if not os.path.isdir(folder):
+            return
+        small = []
+        rows = 0
+        for part in sorted(cls.list_parts(folder), reverse = True):
+            part_rows = pyarrow.parquet.ParquetFile(cls.part_path(folder, part)).metadata.num_rows
+            if part_rows >= row_group_size:
+                break
+            small.append(part)
+            rows += part_rows
+        if len(small) < 2 or rows < row_group_size:
+            return
+
+        first, last = small[-1], small[0]
+        table = pyarrow.concat_tables([pyarrow.parquet.read_table(cls.part_path(folder, part))
+                                       for part in reversed(small)])
+        tmp = os.path.join(folder, f"compact-{first:05d}-{last:05d}.tmp")
+        pyarrow.parquet.write_table(table, tmp, row_group_size = row_group_size)
+        with open(tmp, 'rb') as f:
+            os.fsync(f.fileno())
+        cls.recover(folder)
+
+    @classmethod
+    def recover(cls, folder: str) -> None:
+        """
+        Finish or undo a compaction interrupted by a crash. A complete merged file replaces its parts,
+        an incomplete one is removed.
+        """
+        import pyarrow.parquet
+        for name in os.listdir(folder):
+            if not (name.startswith("compact-") and name.endswith(".tmp")):
+                continue
+            tmp = os.path.join(folder, name)
+            first, last = (int(number) for number in name[8:-4].split("-"))
+            try:
+                pyarrow.parquet.ParquetFile(tmp)
+            except Exception:
+                os.remove(tmp)
+                continue
+            for part in range(last, first, -1):
+                if os.path.exists(cls.part_path(folder, part)):
+                    os.remove(cls.part_path(folder, part))
+            os.replace(tmp, cls.part_path(folder, first))
+
+    def write_header(self) -> None:
+        pass
+
+    def write(self, tx: dict) -> None:
+        for column in self.columns:
+            value = tx[column]
+            if value is not None:
+                if column == "value":
+                    value = Decimal(int(value, 16))
+                elif isinstance(value, (dict, list)):
+                    value = json.dumps(value)
+                elif column not in ("block", "blocktimestamp"):
+                    value = str(value)
+            self.buffer[column].append(value)
+        self.rows += 1
+
+        if self.rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write buffered rows as one row group.
+        """
+        if not self.rows:
+            return
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, self.schema)
+        table = self.pa.Table.from_pydict(self.buffer, schema = self.schema)
+        self.writer.write_table(table, row_group_size = self.rows)
+        self.buffer = {column: [] for column in self.columns}
+        self.rows = 0
+
+    def sync(self) -> None:
+        # Row groups are only written when full, a parquet file is not readable before it's closed anyway.
+        pass
+
+    def position(self) -> int:
+        """
+        Close the current part file and return the number of the next one.
+        """
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.part += 1
+        return self.part
+
+    def rollback(self, position: int) -> None:
+        """
+        Remove part files from position and on.
+        """
+        for part in self.parts():
+            if part >= position:
+                os.remove(self.part_path(self.folder, part))
+        # Parts below position may have been merged into fewer, numbering goes on from position.
+        self.part = max(max(self.parts(), default = -1) + 1, position)
+
+    def close(self) -> None:
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,14 @@
+CREATE TABLE IF NOT EXISTS postings
+(
+    field        TEXT           NOT NULL,
+    value        TEXT           NOT NULL,
+    block        INTEGER        NOT NULL,
+    ordinal      INTEGER        NOT NULL,
+    PRIMARY KEY (field, value, block, ordinal)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS index_state
+(
+    key          TEXT           PRIMARY KEY,
+    value        INTEGER        NOT NULL
+);
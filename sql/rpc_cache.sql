@@ -0,0 +1,11 @@
+-- Cached JSON-RPC responses, zlib compressed.
+-- key is "block:<height>" for blocks and the txhash for transaction results.
+-- used orders entries by last use, the least recently used are evicted first.
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
@@ -0,0 +1,179 @@
+from __future__ import annotations
+import json
+import threading
+import time
+
+
+class Stats:
+    """
+    Timers, counters and histograms for the stages of an extraction.
+
+    Every timed stage keeps a count, the total time and a histogram with power of two
+    microsecond buckets, so the distribution per block or per lookup can be reported
+    without keeping every sample. Stages are timed from several threads, updates are locked.
+    """
+    # Report order, other stages follow sorted by name.
+    STAGES = ["block", "block_wait", "leveldb_get", "leveldb_scan", "leveldb_read", "prefilter", "json_loads", "transaction",
+              "match", "receipt_get", "receipt_loads", "write", "writer_wait", "checkpoint"]
+
+    def __init__(self) -> Stats:
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def add(self, stage: str, seconds: float) -> None:
+        """
+        Record one timing of stage.
+        """
+        bucket = int(seconds * 1000000).bit_length()
+        with self.lock:
+            timer = self.timers.get(stage)
+            if timer is None:
+                timer = self.timers[stage] = {"count": 0, "seconds": 0.0, "max": 0.0, "histogram": {}}
+            timer["count"] += 1
+            timer["seconds"] += seconds
+            if seconds > timer["max"]:
+                timer["max"] = seconds
+            timer["histogram"][bucket] = timer["histogram"].get(bucket, 0) + 1
+
+    def count(self, counter: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def merge(self, other: dict) -> None:
+        """
+        Add the stats of another Stats, as returned by to_dict.
+        """
+        with self.lock:
+            for counter, n in other["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+            for stage, theirs in other["timers"].items():
+                timer = self.timers.setdefault(stage, {"count": 0, "seconds": 0.0, "max": 0.0, "histogram": {}})
+                timer["count"] += theirs["count"]
+                timer["seconds"] += theirs["seconds"]
+                timer["max"] = max(timer["max"], theirs["max"])
+                for bucket, n in theirs["histogram"].items():
+                    timer["histogram"][int(bucket)] = timer["histogram"].get(int(bucket), 0) + n
+
+    @staticmethod
+    def percentile(timer: dict, p: float) -> float:
+        """
+        Return the upper bound in microseconds of the bucket holding percentile p.
+        """
+        target = timer["count"] * p
+        seen = 0
+        for bucket in sorted(timer["histogram"]):
+            seen += timer["histogram"][bucket]
+            if seen >= target:
+                return 2 ** bucket
+        return 0
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {"timers": {stage: dict(timer, histogram = dict(timer["histogram"]))
+                               for stage, timer in self.timers.items()},
+                    "counters": dict(self.counters)}
+
+    def runtime(self) -> float:
+        """
+        Return seconds since the stats were created.
+        """
+        return time.time() - self.started
+
+    def report(self) -> None:
+        """
+        Print the stats, with blocks and transactions per second over the runtime.
+        """
+        seconds = self.runtime()
+        stages = [stage for stage in self.STAGES if stage in self.timers]
+        stages += sorted(stage for stage in self.timers if stage not in self.STAGES)
+
+        print("Stats")
+        print("---------------")
+        print(f"{'Stage':<16}{'count':>12}{'total s':>11}{'mean us':>11}{'p50 us':>10}{'p99 us':>10}{'max us':>11}")
+        for stage in stages:
+            timer = self.timers[stage]
+            mean = timer["seconds"] / timer["count"] * 1000000
+            print(f"{stage:<16}{timer['count']:>12}{timer['seconds']:>11.3f}{mean:>11.1f}"
+                  f"{self.percentile(timer, 0.5):>10}{self.percentile(timer, 0.99):>10}{timer['max'] * 1000000:>11.0f}")
+        print()
+        for counter in sorted(self.counters):
+            print(f"{counter + ':':<35}{self.counters[counter]}")
+        print(f"{'Runtime:':<35}{seconds:.2f} s")
+        for counter in ("blocks", "transactions"):
+            if counter in self.counters:
+                print(f"{counter.capitalize() + '/s:':<35}{self.counters[counter] / seconds:.1f}")
+
+    def save(self, path: str) -> None:
+        """
+        Write the stats to a json file.
+        """
+        data = self.to_dict()
+        data["seconds"] = self.runtime()
+        with open(path, 'w') as f:
+            json.dump(data, f, indent = 2)
+
+
+class Timer:
+    """
+    Times consecutive steps for a Stats. Each lap records the time since the previous lap, or since start,
+    as one timing of a stage. A Timer keeps the time of its last lap, so every thread needs its own.
+    """
+
+    def __init__(self, stats: Stats) -> Timer:
+        self.stats = stats
+        self.last = time.perf_counter()
+
+    def start(self) -> None:
+        self.last = time.perf_counter()
+
+    def split(self) -> float:
+        """
+        Return the seconds since the previous lap and start over, without recording them.
+        """
+        now = time.perf_counter()
+        seconds = now - self.last
+        self.last = now
+        return seconds
+
+    def lap(self, stage: str, seconds: float = 0.0) -> None:
+        """
+        Record the time since the previous lap as a timing of stage, adding seconds split off before.
+        """
+        now = time.perf_counter()
+        self.stats.add(stage, now - self.last + seconds)
+        self.last = now
+
+    def count(self, counter: str, n: int = 1) -> None:
+        self.stats.count(counter, n)
+
+
+class NoTimer:
+    """
+    Timer recording nothing, used when there are no stats. Keeps no state, so it's shared by all threads.
+    """
+
+    def start(self) -> None:
+        pass
+
+    def split(self) -> float:
+        return 0.0
+
+    def lap(self, stage: str, seconds: float = 0.0) -> None:
+        pass
+
+    def count(self, counter: str, n: int = 1) -> None:
+        pass
+
+
+NO_TIMER = NoTimer()
+
+
+def timer(stats: Stats = None) -> Timer:
+    """
+    Return a Timer for stats, or the NoTimer if stats is None, so a stage has the same code timed or not.
+    """
+    if stats:
+        return Timer(stats)
+    return NO_TIMER
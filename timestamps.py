@@ -0,0 +1,87 @@
+from __future__ import annotations
+import datetime
+from mapped import MappedFile
+
+
+class TimestampIndex(MappedFile):
+    """
+    Persistent array of block timestamps indexed by height, in a memory mapped file of 8 byte integers.
+    0 marks a height not looked up yet. Timestamps are read from the blockchain as binary searches need them
+    and kept, so later searches mostly run against the file.
+    """
+    ITEMSIZE = 8
+
+    def __init__(self, path: str) -> TimestampIndex:
+        self.array = None
+        MappedFile.__init__(self, path)
+
+    def __len__(self) -> int:
+        return len(self.array) if self.array is not None else 0
+
+    def map(self) -> None:
+        MappedFile.map(self)
+        if self.mm is not None:
+            self.array = memoryview(self.mm).cast('q')
+
+    def unmap(self) -> None:
+        if self.array is not None:
+            self.array.release()
+            self.array = None
+        MappedFile.unmap(self)
+
+    def get(self, height: int) -> int:
+        """
+        Return the timestamp of height, None if not known.
+        """
+        if height < len(self) and self.array[height]:
+            return self.array[height]
+        return None
+
+    def set(self, height: int, timestamp: int) -> None:
+        self.reserve((height + 1) * self.ITEMSIZE)
+        self.array[height] = timestamp
+
+    def timestamp(self, height: int, read_block) -> int:
+        """
+        Return the timestamp of height, reading the block with read_block(height) if not known.
+        """
+        timestamp = self.get(height)
+        if timestamp is None:
+            timestamp = read_block(height).timestamp
+            self.set(height, timestamp)
+        return timestamp
+
+    def search(self, timestamp: int, firstblock: int, lastblock: int, read_block) -> int:
+        """
+        Binary search for the first block in firstblock - lastblock with a timestamp at or after timestamp.
+        Input:
+            timestamp (int)  - microseconds since epoch, as in blocks.
+            read_block       - function returning the Block of a height.
+        Return:
+            height (int) - lastblock + 1 if every block is earlier.
+        """
+        lo, hi = firstblock, lastblock + 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid, read_block) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+def parse_time(value: str) -> int:
+    """
+    Parse a point in time given on the command line, as a date or date and time in ISO format (UTC if no
+    timezone is given) or as seconds since epoch.
+    Return:
+        timestamp (int) - microseconds since epoch.
+    """
+    try:
+        return int(float(value) * 1000000)
+    except ValueError:
+        pass
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo = datetime.timezone.utc)
+    return int(moment.timestamp() * 1000000)
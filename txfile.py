@@ -1,8 +1,25 @@
+from __future__ import annotations
+from collections import OrderedDict
 import configparser
 import textwrap
 import json
-import csv
 import os
+import shutil
+from sinks import CsvSink
+from sinks import ParquetSink
+from sinks import SqliteSink
+
+
+def write_config(inifile: str, config: configparser.ConfigParser) -> None:
+    """
+    Write config to inifile. The file is replaced atomically, so a crash never leaves it half written.
+    """
+    tmpfile = inifile + ".tmp"
+    with open(tmpfile, 'w') as configfile:
+        config.write(configfile)
+        configfile.flush()
+        os.fsync(configfile.fileno())
+    os.replace(tmpfile, inifile)
 
 
 class TxFile:
@@ -12,9 +29,12 @@ class TxFile:
     load the file settigs, removing a file etc.
     """
 
+    FORMATS = {"csv": (".csv",), "sqlite": (".db", ".sqlite", ".sqlite3"), "parquet": (".parquet",)}
+
     def __init__(self, name = None, folder = None, inifile = None, from_ = [], to = [],
-                 datatypes = [], methods = [], params = [], include_failed_tx = False, columns = None, firstblock = None,
-                 lastblock = None, transactions= 0):
+                 datatypes = [], methods = [], params = [], where = [], include_failed_tx = False, columns = None, firstblock = None,
+                 lastblock = None, transactions= 0, format = "csv", table = None, batch_size = 1000,
+                 row_group_size = 100000, offset = None, config = None):
         self.name = name
         self.folder = folder
         self.inifile = inifile
@@ -23,16 +43,28 @@ class TxFile:
         self.datatypes = datatypes
         self.methods = methods
         self.params = params
+        self.where = where
         self.include_failed_tx = include_failed_tx
         self.columns = columns
         self.firstblock = firstblock
         self.lastblock = lastblock
         self.transactions = 0
+        self.format = format
+        self.table = table
+        self.batch_size = batch_size
+        self.row_group_size = row_group_size
+        self.offset = offset
+
+        # Parsed inifile shared with other TxFiles, see Registry. Read on every call if None.
+        self.config = config
 
         self.rules = None
 
-        self.__fileobj = None
-        self.__csvwriter = None
+        self.__sink = None
+
+        # Set when opened in a FilePool. Transactions are then buffered in pending.
+        self.pool = None
+        self.__pending = []
 
         self.name
 
@@ -42,12 +74,7 @@ class TxFile:
         Return:
             bool  -  true if exists and false of not.
         """
-    
-        config = configparser.ConfigParser()
-        config.read(self.inifile)
-        sections = config.sections()
-
-        if self.name in sections:
+        if self.read_config().has_section(self.name):
             return True
         else:
             return False
@@ -58,9 +85,6 @@ class TxFile:
         Return:
             bool  -  true if exists and false if not.
         """
-        config = configparser.ConfigParser()
-        config.read(self.inifile)
-        
         if os.path.exists(self.folder + self.name):
             return True
         else:
@@ -71,11 +95,9 @@ class TxFile:
         Load file settings from inifile.
         """
 
-        if not self.exists_in_config():
+        config = self.read_config()
+        if not config.has_section(self.name):
             raise FileNotFoundError("File does not exist in configuration file.")
-        
-        config = configparser.ConfigParser()
-        config.read(self.inifile)
 
         # Load folder
         if config.has_option(self.name, "folder"):
@@ -92,9 +114,21 @@ class TxFile:
             self.methods = json.loads(config[self.name]['methods'])
         if config.has_option(self.name, "params"):
             self.params = json.loads(config[self.name]['params'])
+        if config.has_option(self.name, "where"):
+            self.where = json.loads(config[self.name]['where'])
         if config.has_option(self.name, "include_failed_tx"):
             self.include_failed_tx = json.loads(config[self.name]['include_failed_tx'])
         
+        # Load output format.
+        if config.has_option(self.name, "format"):
+            self.format = config[self.name]['format']
+        if config.has_option(self.name, "table"):
+            self.table = config[self.name]['table']
+        if config.has_option(self.name, "sqlite_batch_size"):
+            self.batch_size = config.getint(self.name, 'sqlite_batch_size')
+        if config.has_option(self.name, "parquet_row_group_size"):
+            self.row_group_size = config.getint(self.name, 'parquet_row_group_size')
+
         # Load columns.
         if config.has_option(self.name, "columns"):
             self.columns = json.loads(config[self.name]['columns'])
@@ -106,13 +140,16 @@ class TxFile:
             self.lastblock = int(config[self.name]['lastblock'])
         if config.has_option(self.name, "transactions"):
             self.transactions = int(config[self.name]['transactions'])
+        if config.has_option(self.name, "offset"):
+            self.offset = int(config[self.name]['offset'])
 
-    def save_config(self) -> None:
+    def save_config(self, write: bool = True, config: configparser.ConfigParser = None) -> None:
         """
         Save file setting in inifile.
+        With write false the settings are only updated in the parsed config, or in config if given, to be written later.
         """
-        config = configparser.ConfigParser()
-        config.read(self.inifile)
+        if config is None:
+            config = self.read_config()
 
         if not config.has_section(self.name):
             config.add_section(self.name)
@@ -126,8 +163,14 @@ class TxFile:
         config[self.name]['datatypes'] = json.dumps(self.datatypes)
         config[self.name]['methods'] = json.dumps(self.methods)
         config[self.name]['params'] = json.dumps(self.params)
+        config[self.name]['where'] = json.dumps(self.where)
         config[self.name]['include_failed_tx'] = json.dumps(self.include_failed_tx)
 
+        # Save output format.
+        config[self.name]['format'] = self.format
+        if self.table:
+            config[self.name]['table'] = self.table
+
         # Save columns
         if self.columns:
             config[self.name]['columns'] = json.dumps(self.columns)
@@ -139,68 +182,154 @@ class TxFile:
             config[self.name]['lastblock'] = str(self.lastblock)
         if self.transactions:
             config[self.name]['transactions'] = str(self.transactions)
+        if self.offset is not None:
+            config[self.name]['offset'] = str(self.offset)
         
         # Write to file.
-        with open(self.inifile, 'w') as configfile:
-            config.write(configfile)
+        if write:
+            write_config(self.inifile, config)
 
-    def delete_config(self) -> None:
+    def delete_config(self, write: bool = True) -> None:
         """
         Delete file settings from inifile.
         """
-        config = configparser.ConfigParser()
-        config.read(self.inifile)
+        config = self.read_config()
         config.remove_section(self.name)
+        if write:
+            write_config(self.inifile, config)
 
-        with open(self.inifile, 'w') as configfile:
-            config.write(configfile)
+    def read_config(self) -> configparser.ConfigParser:
+        """
+        Return the shared config if there is one, otherwise parse the inifile.
+        """
+        if self.config is not None:
+            return self.config
+        config = configparser.ConfigParser(interpolation = None)
+        config.read(self.inifile)
+        return config
 
     def delete_file(self) -> None:
         """
         Delete file.
         """
-
-        os.remove(self.folder + self.name)
+        path = self.folder + self.name
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
         
     def set_rules(self) -> None:
         """
         Set rules attribute.
         """
         rules = {}
-        parser = configparser.ConfigParser()
-        parser.read(self.inifile)
-        rules['from_'] = set(json.loads(parser.get(self.name, 'from')))
-        rules['to'] = set(json.loads(parser.get(self.name, 'to')))
-        rules['datatypes'] = set(json.loads(parser.get(self.name, 'datatypes')))
-        rules['methods'] = set(json.loads(parser.get(self.name, 'methods')))
-        rules['params'] = set(json.loads(parser.get(self.name, 'params')))
+        rules['from_'] = set(self.from_)
+        rules['to'] = set(self.to)
+        rules['datatypes'] = set(self.datatypes)
+        rules['methods'] = set(self.methods)
+        rules['params'] = set(self.params)
+        rules['where'] = tuple(self.where)
         self.rules = rules
 
     def create_file(self) -> None:
         """
         Create file in specified output folder.
         """
-        open(self.folder + self.name, 'w').close()
+        if self.format == "sqlite":
+            self.open('w')
+            self.close()
+        elif self.format == "parquet":
+            os.makedirs(self.folder + self.name, exist_ok = True)
+        else:
+            open(self.folder + self.name, 'w').close()
 
-    def open(self, mode: str) -> None:
+    def open(self, mode: str, pool: FilePool = None) -> None:
         """
         Opens the file in the output directory. Creates it if it does not exists.
+        In append mode, anything written after the last checkpoint is removed.
+        With a pool, the file may be closed while not in use and is reopened when written to.
         """
         if mode not in ['w', 'a']:
             raise NotImplementedError("Only append and write mode are supported.")
 
-        if not self.exists_in_output():
+        if self.format != "sqlite" and not self.exists_in_output():
             raise FileNotFoundError("File does not exist in output folder specified in configuration file.")
 
-        self.__fileobj = open(self.folder + self.name, mode)
-        self.__csvwriter = csv.writer(self.__fileobj)
+        self.open_sink(mode)
+        if mode == 'a' and self.offset is not None:
+            self.__sink.rollback(self.offset)
+            self.compact()
+
+        self.pool = pool
+        if pool:
+            pool.add(self)
+
+    def open_sink(self, mode: str) -> None:
+        """
+        Open the writer for the file format.
+        """
+        path = self.folder + self.name
+        if self.format == "sqlite":
+            self.__sink = SqliteSink(path, self.table, self.columns, self.batch_size)
+        elif self.format == "parquet":
+            self.__sink = ParquetSink(path, self.columns, self.row_group_size)
+        else:
+            self.__sink = CsvSink(path, mode, self.columns)
+
+    def compact(self) -> None:
+        """
+        Merge the small part files of a parquet file left by checkpoints, once they add up to a row group.
+        Other formats are left as they are. Only call when everything written to the file is part of a saved checkpoint,
+        as when it's opened for appending.
+        """
+        if self.format == "parquet":
+            ParquetSink.compact(self.folder + self.name, self.row_group_size)
+
+    def suspend(self) -> None:
+        """
+        Sync and close the file until it's written to again. Called by the pool.
+        """
+        self.__sink.sync()
+        self.offset = self.__sink.position()
+        self.__sink.close()
+        self.__sink = None
+
+    def write_pending(self) -> None:
+        """
+        Write transactions buffered while in a pool, reopening the file if needed.
+        """
+        if not self.__pending:
+            return
+        if self.__sink is None:
+            self.open_sink('a')
+        self.pool.add(self)
+        for tx in self.__pending:
+            self.__sink.write(tx)
+        self.__pending = []
+
+    def checkpoint(self) -> None:
+        """
+        Sync the file to disk and set offset to the position written up to.
+        The config has to be saved for the checkpoint to be recorded.
+        """
+        self.write_pending()
+        # A suspended file was synced and had its offset set when closed.
+        if self.__sink is not None:
+            self.__sink.sync()
+            self.offset = self.__sink.position()
     
     def close(self) -> None:
         """
-        Close the file.
+        Close the file. offset is set to the position written up to.
         """
-        self.__fileobj.close()
-        self.__fileobj = None
+        self.write_pending()
+        if self.__sink is not None:
+            self.offset = self.__sink.position()
+            self.__sink.close()
+            self.__sink = None
+        if self.pool:
+            self.pool.remove(self)
+            self.pool = None
 
     
     def append_transaction(self, tx: dict) -> None:
@@ -212,22 +341,35 @@ class TxFile:
         Output:
            None
         """
-        tx = [tx[column] for column in self.columns]
-        self.__csvwriter.writerow(tx)
+        if self.pool is None:
+            self.__sink.write(tx)
+            return
+
+        self.__pending.append(tx)
+        if len(self.__pending) >= self.pool.buffer_rows:
+            self.write_pending()
+
+
+    def sync(self) -> None:
+        """
+        Write buffered transactions and sync the file to disk.
+        """
+        if self.__sink is not None:
+            self.__sink.sync()
 
 
     def write_header_row(self) -> None:
         """
         Write header for csv file.
         """
-        self.__csvwriter.writerow(self.columns)
+        self.__sink.write_header()
 
 
     def clear_all_transactions(self):
         """
         Clears all transactions from the file.
         """
-        if self.__fileobj:
+        if self.__sink:
             raise Exception("The file is already open. Close the file and try again.")
         
         open(self.outputfolder + self.name, 'w').close()
@@ -274,12 +416,45 @@ class TxFile:
             print(f"Params            : {sep.join(self.params)}")
         else:
             print(f"Params            : No filter")
+        for expression in self.where:
+            print(f"Where             : {expression}")
         if self.include_failed_tx:
             print(f"Include_failed_tx : True")
         else:
             print(f"Include_failed_tx : False")
+        print(f"Format            : {self.format}")
+        if self.table:
+            print(f"Table             : {self.table}")
         if self.columns:
             print(f"Columns           : {sep.join(self.columns)}")
         print(f"Firstblock        : {self.firstblock}")
         print(f"Lastblock         : {self.lastblock}")
         print(f"Transactions      : {self.transactions}")
+
+
+
+class FilePool:
+    """
+    Keeps at most size TxFiles open. The least recently written file is synced and closed
+    when another one needs to be opened, and reopened when written to again.
+    Each file buffers buffer_rows transactions before it's written to, so files
+    that rarely get a transaction are rarely opened.
+    """
+
+    def __init__(self, size: int = 256, buffer_rows: int = 1000) -> FilePool:
+        self.size = max(1, size)
+        self.buffer_rows = max(1, buffer_rows)
+        self.files = OrderedDict()
+
+    def add(self, txfile: TxFile) -> None:
+        """
+        Mark txfile as open and most recently used. Closes the least recently used files if full.
+        """
+        self.files[txfile] = True
+        self.files.move_to_end(txfile)
+        while len(self.files) > self.size:
+            oldest, _ = self.files.popitem(last = False)
+            oldest.suspend()
+
+    def remove(self, txfile: TxFile) -> None:
+        self.files.pop(txfile, None)
@@ -0,0 +1,95 @@
+from __future__ import annotations
+import queue
+import threading
+import time
+
+
+class AsyncWriter(threading.Thread):
+    """
+    Writes transactions to TxFiles on a background thread.
+
+    Rows are handed over in batches through a bounded queue. When the queue is full the
+    extraction waits, so memory stays bounded even when a file matches a lot of transactions.
+    Files can be synced to disk every fsync_interval seconds.
+    """
+
+    def __init__(self, depth: int = 1000, fsync_interval: float = 0, stats: Stats = None) -> AsyncWriter:
+        """
+        Input:
+            depth (int)            - maximum number of batches waiting to be written.
+            fsync_interval (float) - seconds between syncs of written files to disk. 0 disables syncing.
+            stats (Stats)          - records write times if given.
+        """
+        threading.Thread.__init__(self, daemon = True)
+        self.queue = queue.Queue(maxsize = max(1, depth))
+        self.fsync_interval = fsync_interval
+        self.stats = stats
+        self.error = None
+        self.written = set()
+
+    def run(self) -> None:
+        last_sync = time.time()
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    if self.error is None:
+                        self.sync()
+                elif self.error is None:
+                    start = time.perf_counter()
+                    for txfile, tx in batch:
+                        txfile.append_transaction(tx)
+                        self.written.add(txfile)
+                    if self.stats:
+                        self.stats.add("write", time.perf_counter() - start)
+
+                    if self.fsync_interval and time.time() - last_sync >= self.fsync_interval:
+                        self.sync()
+                        last_sync = time.time()
+            except Exception as e:
+                # Raised in the extraction thread on the next append or close.
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+            if batch is None:
+                return
+
+    def sync(self) -> None:
+        """
+        Sync all files written to since last sync.
+        """
+        for txfile in self.written:
+            txfile.sync()
+        self.written = set()
+
+    def append(self, batch: list) -> None:
+        """
+        Queue (txfile, transaction) pairs for writing. Blocks while the queue is full.
+        """
+        while True:
+            self.check()
+            try:
+                self.queue.put(batch, timeout = 0.1)
+                return
+            except queue.Full:
+                continue
+
+    def flush(self) -> None:
+        """
+        Wait until everything queued has been written.
+        """
+        self.queue.join()
+        self.check()
+
+    def close(self) -> None:
+        """
+        Write everything queued, sync and stop the thread.
+        """
+        self.queue.put(None)
+        self.join()
+        self.check()
+
+    def check(self) -> None:
+        if self.error is not None:
+            raise self.error